@@ -0,0 +1,255 @@
+# Client for the GeniePool REST API (api.geniepool.link): pooled keep-alive sessions, connect/read
+# timeouts, bounded retries with jittered backoff and a circuit breaker that makes callers fail
+# fast (and go to the S3 fallback) while the API is unhealthy. /rest/index response bodies are kept
+# in an in-process LRU that is dropped whenever the dataset's update_date changes.
+
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+API_ROOT = os.environ.get('GENIEPOOL_API_ROOT', 'http://api.geniepool.link/rest/index')
+CONNECT_TIMEOUT = float(os.environ.get('GENIEPOOL_API_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('GENIEPOOL_API_READ_TIMEOUT', 20))
+RETRIES = int(os.environ.get('GENIEPOOL_API_RETRIES', 2))
+BACKOFF = float(os.environ.get('GENIEPOOL_API_BACKOFF', 0.25))
+POOL_SIZE = int(os.environ.get('GENIEPOOL_API_POOL_SIZE', 10))
+CACHE_BYTES = int(os.environ.get('GENIEPOOL_API_CACHE_BYTES', 256 * 1024 ** 2))
+CACHE_TTL = float(os.environ.get('GENIEPOOL_API_CACHE_TTL', 6 * 3600))
+VERSION_CHECK_INTERVAL = float(os.environ.get('GENIEPOOL_API_VERSION_CHECK_INTERVAL', 300))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `failureThreshold` consecutive failed calls; after `resetTimeout` seconds a single
+    # trial call is let through, and its outcome closes or re-opens the circuit.
+
+    def __init__(self, failureThreshold = 5, resetTimeout = 30):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.failures = 0
+        self.openedAt = None
+        self.trialInFlight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.openedAt == None:
+                return True
+            if time.monotonic() - self.openedAt < self.resetTimeout or self.trialInFlight:
+                return False
+            self.trialInFlight = True
+            return True
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trialInFlight = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            self.trialInFlight = False
+            if self.failures >= self.failureThreshold:
+                self.openedAt = time.monotonic()
+
+    def state(self):
+        with self.lock:
+            if self.openedAt == None:
+                return 'closed'
+            return 'open' if time.monotonic() - self.openedAt < self.resetTimeout else 'half-open'
+
+
+class ResponseCache:
+    # key -> (dataset version, expiry time, size in bytes, response body), bounded by total size.
+    # Bodies are kept as received and parsed on each hit: parsed JSON takes several times the memory
+    # of its text, which would make the byte bound meaningless.
+
+    def __init__(self, maxBytes = CACHE_BYTES, ttl = CACHE_TTL):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and (entry[0] != version or entry[1] < time.monotonic()):
+                self.remove(key)
+                entry = None
+            if entry == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            body = entry[3]
+        return json.loads(body)
+
+    def put(self, key, version, body):
+        size = len(body)
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (version, time.monotonic() + self.ttl, size, body)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            self.bytes -= entry[2]
+
+    def invalidate(self, reference):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == reference]:
+                self.remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {'entries' : len(self.entries), 'bytes' : self.bytes, 'max_bytes' : self.maxBytes, 'hits' : self.hits, 'misses' : self.misses}
+
+
+def normalizeRegion(coordinates):
+    coordinates = coordinates.strip().replace(' ', '').replace(',', '')
+    if coordinates.lower().startswith('rs'):
+        return coordinates.lower()
+    return coordinates.upper().replace('CHR', '')
+
+def isRetryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(error, requests.HTTPError) and error.response != None and error.response.status_code >= 500
+
+
+class GeniePoolClient:
+
+    def __init__(self, root = API_ROOT, connectTimeout = CONNECT_TIMEOUT, readTimeout = READ_TIMEOUT, retries = RETRIES, backoff = BACKOFF, poolSize = POOL_SIZE, breaker = None):
+        self.root = root.rstrip('/')
+        self.timeout = (connectTimeout, readTimeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.poolSize = poolSize
+        self.breaker = breaker if breaker != None else CircuitBreaker()
+        self.local = threading.local()
+        self.cache = ResponseCache()
+        self.versions = {}
+        self.versionRefreshes = set()
+        self.versionLock = threading.Lock()
+
+    def session(self):
+        # One pooled session per thread of each worker process (sessions must not cross a fork).
+        session = getattr(self.local, 'session', None)
+        if session == None or self.local.pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections = self.poolSize, pool_maxsize = self.poolSize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            self.local.pid = os.getpid()
+        return session
+
+    def indexQuery(self, reference, coordinates, qual = None, ad = None, gnomadNhomalt = None, gnomadAc = None, am = None):
+        query = self.root + '/' + reference + '/' + coordinates
+        parameters = []
+        if qual != None:
+            parameters.append('qual=' + str(qual))
+        if ad != None:
+            parameters.append('ad=' + str(ad))
+        if str(gnomadNhomalt) not in ('0', 'None'):
+            parameters.append('gnomad_nhomalt=' + str(gnomadNhomalt))
+        if str(gnomadAc) not in ('0', 'None'):
+            parameters.append('gnomad_ac=' + str(gnomadAc))
+        if am not in (0, None):
+            parameters.append('am=' + str(am))
+        if len(parameters) > 0:
+            query += '?' + '&'.join(parameters)
+        return query
+
+    def statusQuery(self, reference):
+        return self.root + '/' + reference + '/status'
+
+    def request(self, query):
+        # Parsed JSON body of `query` and the body as received.
+        if self.breaker.allow() == False:
+            raise CircuitOpenError('GeniePool API circuit is open')
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session().get(query, timeout = self.timeout)
+                response.raise_for_status()
+                data = response.json()
+                break
+            except Exception as error:
+                retryable = isRetryable(error)
+                if attempt == self.retries or retryable == False:
+                    # Only unreachable or failing upstreams count against the circuit; a 4xx or an
+                    # unexpected payload still means the API is up.
+                    if retryable:
+                        self.breaker.recordFailure()
+                    else:
+                        self.breaker.recordSuccess()
+                    raise
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+        self.breaker.recordSuccess()
+        return data, response.content
+
+    def get(self, query):
+        return self.request(query)[0]
+
+    def datasetVersion(self, reference):
+        # update_date of the reference's dataset, re-checked at most every VERSION_CHECK_INTERVAL seconds.
+        # The check runs in the background, so callers never wait on /status: they get the last
+        # known version, None until the first check has answered.
+        with self.versionLock:
+            known = self.versions.get(reference)
+            if known != None and time.monotonic() - known[1] < VERSION_CHECK_INTERVAL:
+                return known[0]
+            if reference not in self.versionRefreshes:
+                self.versionRefreshes.add(reference)
+                threading.Thread(target = self.refreshVersion, args = (reference,), daemon = True).start()
+            return known[0] if known != None else None
+
+    def refreshVersion(self, reference):
+        with self.versionLock:
+            known = self.versions.get(reference)
+        try:
+            version = self.status(reference)['update_date']
+        except Exception:
+            version = known[0] if known != None else None
+        with self.versionLock:
+            self.versions[reference] = (version, time.monotonic())
+            self.versionRefreshes.discard(reference)
+        if known != None and version != known[0]:
+            self.cache.invalidate(reference)
+
+    def index(self, reference, coordinates, qual = None, ad = None, gnomadNhomalt = None, gnomadAc = None, am = None):
+        region = normalizeRegion(coordinates)
+        key = (reference, region, qual, ad,
+               None if str(gnomadNhomalt) in ('0', 'None') else str(gnomadNhomalt),
+               None if str(gnomadAc) in ('0', 'None') else str(gnomadAc),
+               None if am in (0, None) else str(am))
+        version = self.datasetVersion(reference)
+        data = self.cache.get(key, version)
+        if data == None:
+            data, body = self.request(self.indexQuery(reference, region, qual, ad, gnomadNhomalt, gnomadAc, am))
+            if version != None:
+                self.cache.put(key, version, body)
+        return data
+
+    def status(self, reference):
+        return self.get(self.statusQuery(reference))
+
+apiClient = GeniePoolClient()
@@ -4,10 +4,8 @@
 # In[ ]:
 
 
-import requests
-import json, urllib, re
+import numpy as np
 import pandas as pd
-from time import sleep
 
 import dash
 import flask
@@ -15,6 +13,16 @@ from dash.dependencies import Input, Output, State
 from dash import dcc, html, dash_table
 
 import plotly.graph_objects as go
+from urllib.parse import urlencode
+
+from referencedata import ReferenceTables
+from indexes import AttributeIndex, GeneIndex, GeneIntervalIndex, StudyIndex, column, fixedWidth, sampleDictionary
+from partitions import PartitionMap, MIRROR_ROOT, partitionCache
+from apiclient import apiClient
+from search import RegionSearch
+from cooccurrence import CoOccurrence, parseVariants
+from results import ResultStore, VariantResult, filterFrame, page, sortFrame
+import export
 
 
 # In[ ]:
@@ -29,6 +37,31 @@ app.title = "GeniePool"
 def serve_pdf():
     return flask.send_from_directory('assets', 'GeniePool_API_documentation.pdf')
 
+@server.route('/export/<token>')
+def serve_export(token):
+    # Streams the calls of a stored search as the table shows them:
+    # ?format=csv|tsv|parquet|vcf&qual=&coverage=[&filter=][&sort=column:asc|desc ...][&attribute= ...]
+    search = resultStore.get(token)
+    if search == None:
+        flask.abort(404)
+    exportFormat = flask.request.args.get('format', 'csv')
+    if exportFormat not in export.FORMATS:
+        flask.abort(400)
+    minQual = flask.request.args.get('qual', 0, type = float)
+    minCoverage = flask.request.args.get('coverage', 0, type = float)
+    sortBy = [{'column_id' : column, 'direction' : direction} for column, _, direction in (i.rpartition(':') for i in flask.request.args.getlist('sort'))]
+    view = tableView(search, buildView(search, minQual, minCoverage), minQual, minCoverage,
+                     flask.request.args.getlist('attribute'), flask.request.args.get('filter'), sortBy)
+    variants = search['calls'].variantsOf(view['row'].to_numpy(), minQual, minCoverage)
+    genes = geneIntervals.annotate(search['reference'], search['calls'].variants['Coordinate'])
+    chunks = export.stream(exportFormat, search['calls'], genes, search['reference'], minQual, minCoverage, variants)
+    return flask.Response(flask.stream_with_context(chunks), mimetype = export.FORMATS[exportFormat],
+                          headers = {'Content-Disposition' : 'attachment; filename=GeniePool.' + exportFormat})
+
+@server.route('/stats')
+def serve_stats():
+    return flask.jsonify({'partition_cache' : partitionCache.stats(), 'api_cache' : apiClient.cache.stats(), 'api_circuit' : apiClient.breaker.state(), 'range_cache' : regionSearch.rangeCache.stats(), 'single_flight' : regionSearch.flights.stats(), 'hedging' : regionSearch.stats(), 'result_store' : resultStore.stats(), 'reference_data' : referenceTables.stats()})
+
 #app.config['suppress_callback_exceptions'] = False
 app.index_string = """<!DOCTYPE html>
 <html>
@@ -62,14 +95,26 @@ app.index_string = """<!DOCTYPE html>
 
 default_style = {'width' : '57%', 'height' : '100%', 'font-family' : 'gisha', 'marginLeft' : 'auto', 'marginRight' : 'auto', 'textAlign' : 'center'}
 chromosomes = [str(i) for i in range(1,23)] + ['X','Y','M']
+tableColumns = ['Coordinate','Gene','Variant','Homozygotes','Heterozygotes','Impact', 'gnomAD frequency', 'gnomAD homozygotes','dbSNP']
 info_style = {'width' : '100%', 'height' : '100%', 'font-family' : 'gisha', 'marginLeft' : 'auto', 'marginRight' : 'auto', 'textAlign' : 'left'}
 study_style = {'marginBottom' : '10px', 'width' : '100%', 'paddingLeft' : '2px', 'borderWidth': '2px', 'borderStyle': 'groove', 'borderRadius': '5px', 'display' : 'inline-block', 'textAlign' : 'left'}
+download_style = {'marginTop': '1', 'font-family' : 'gisha', 'marginRight': 3, 'fontSize': '100%', 'padding' : 8, 'display' : 'inline-block', 'text-decoration' : 'none', 'backgroundColor' : 'white', 'border-radius' : 10, 'color' : 'black'}
 link_style = {'fontSize' : '125%', 'marginTop' : '2px', 'padding' : 6, 'borderWidth': '2px', 'borderStyle': 'groove', 'borderRadius': '5px', 'font-family' : 'gisha'}
-SRA_studies_and_samples = pd.read_csv('assets/SRA_studies_and_samples.tsv', sep = '\t')
-s3map = pd.read_csv('assets/S3.map', sep = '\t', header = None, names = ['version', 'reference', 'chromosome', 'modulus', 'id'])
-s3map['chromosome'] = s3map['chromosome'].astype(str)
-genes_to_coordinates = pd.read_parquet('assets/genes_to_coordinates.parquet')
-geneNames = genes_to_coordinates['Gene'].tolist()
+referenceTables = ReferenceTables()
+referenceTables.load('samples', lambda tables : sampleDictionary.load(fixedWidth(column(tables['samples'], 'Run'))), 'samples')
+studyIndex = referenceTables.load('studies', StudyIndex.fromTables, 'samples')
+studiesPerPage = 20
+if MIRROR_ROOT == None:
+    partitionMap = referenceTables.load('partitions', PartitionMap.fromTables, 'partitions')
+else:
+    partitionMap = PartitionMap.fromLayout(MIRROR_ROOT)
+regionSearch = RegionSearch(apiClient, partitionMap, mirror = MIRROR_ROOT != None)
+coOccurrence = CoOccurrence(regionSearch)
+resultStore = ResultStore()
+geneIndex = referenceTables.load('genes', GeneIndex.fromTables, 'genes')
+geneIntervals = referenceTables.load('gene_intervals', GeneIntervalIndex.fromTables, 'genes')
+attributeIndex = referenceTables.load('attributes', AttributeIndex.fromTables, 'samples')
+referenceTables.ready()
 coordinatesInputPlaceHolder = 'Enter coordinate/s, Gene symbol or dbSNP name'
 break_line = html.Hr(style={'height' : '4px', 'width' : '60%', 'color' : '#111111','display' : 'inline-block', 'marginLeft':'auto', 'marginRight':'auto'})
 
@@ -104,17 +149,30 @@ app.layout = html.Div([
                 id = 'coOccurrenceMode',
                 options=[
                     {'label': 'Single variant', 'value': 'Single'},
-                    {'label': 'Two variant co-occurrence', 'value': 'Compound'},
+                    {'label': 'Multi-variant co-occurrence', 'value': 'Compound'},
                 ],
                 value = 'Single',
                 labelStyle = {'display': 'inline-block'},
                 style = {'marginTop' : 0,'marginBottom' : 0, 'float' : 'center', 'width': '100%', 'display': 'inline-block', 'textAlign' : 'center'}
             ),
-            html.P('Find samples with two different specific varaints. See FAQs for more information.', id = 'variantCoOccurenceDescription', style = {'display' : 'none'}),
+            html.Div([
+                html.P('Find samples with all of the given variants; separate several variants in a field with ";". See FAQs for more information.'),
+                dcc.RadioItems(
+                    id = 'coOccurrenceZygosity',
+                    options = [
+                        {'label': 'Any zygosity', 'value': 'any'},
+                        {'label': 'Heterozygous only', 'value': 'het'},
+                        {'label': 'Homozygous only', 'value': 'hom'},
+                    ],
+                    value = 'any',
+                    labelStyle = {'display': 'inline-block'},
+                ),
+            ], id = 'variantCoOccurenceDescription', style = {'display' : 'none'}),
             dcc.Input(
                 id = 'coordinates',
                 placeholder = coordinatesInputPlaceHolder,
                 type = "_",
+                list = 'gene_suggestions',
                 style = {
                     'textAlign' : 'center',
                     'fontSize' : 20,
@@ -130,6 +188,7 @@ app.layout = html.Div([
                     'marginTop' : 15,
                 }
             ),
+            html.Datalist(id = 'gene_suggestions'),
             dcc.Input(
                 id = 'coordinates2',
                 placeholder = 'Variant #2, e.g. 2:2000-C-G',
@@ -304,12 +363,11 @@ app.layout = html.Div([
     dcc.Store(id = 'gnomADmaxAC'),
     dcc.Store(id = 'minAlphaMissense'),
     dcc.Store(id = 'n_click_track'),
-    dcc.Store(id = 'studiesDict'),
+    dcc.Store(id = 'selectedVariant'),
     dcc.Store(id = 'variantNumber'),
     dcc.Store(id = 'minQual'),
     dcc.Store(id = 'minCoverage'),
-    dcc.Store(id = 'tableData'),
-    dcc.Download(id = 'download-dataframe-csv'),
+    dcc.Store(id = 'searchToken'),
 ])
 
 
@@ -329,8 +387,11 @@ def generateFAQs(isExpanded):
     if isExpanded == False:
         return [None]
     else:
-        status = json.loads(requests.get('http://api.geniepool.link/rest/index/hg38/status').text)
-        status = 'Last update: ' + '/'.join(status['update_date'].split(' ')[0].split('-')[::-1]) + ' - ' + '{:,}'.format(status['mutations_num']) + ' variants in ' + '{:,}'.format(status['samples_num']) + ' samples.'
+        try:
+            status = apiClient.status('hg38')
+            status = 'Last update: ' + '/'.join(status['update_date'].split(' ')[0].split('-')[::-1]) + ' - ' + '{:,}'.format(status['mutations_num']) + ' variants in ' + '{:,}'.format(status['samples_num']) + ' samples.'
+        except:
+            status = 'Update information is unavailable at the moment.'
         faqs = []
         faqs += qna('Is GeniePool free? Do I need to create a user to use it?',
                    'This website is free and open to all users and there is no login requirement.')
@@ -345,10 +406,10 @@ def generateFAQs(isExpanded):
                    'GeniePool contains data from multiple studies that used various sequencing techniques, some are better than others. Therefore, to avoid noisy results (e.g. a homozygous variant detected by a single read sequence) you can choose to filter by the amount of reads that covered the location of the variant and the sequencing quality.')
         faqs += qna('Has AlphaMissense been integrated into GeniePool?',
                    'Yes! each missense variant has a colored circle - 🔴/🟡/🟢 - Hover your mouse over it to view the AlphaMissense score and prediction.')
-        faqs += qna('What is the "Two variant co-occurrence" option?',
-                    'GeniePool enables you to look for specific samples that have two different variants. To use this options, specific variants must be written in a chr:pos-ref-alt pattern and not a range, e.g. chr1:12345-A-C.')
-        faqs += qna('Is the "Two variant co-occurrence" option suitable for finding compound-heterozygotes?',
-                    'Yes and no. While you may be able to find samples with both input variants using the "Two Variant Co-occurrence" option, it does not guarantee that they are on different alleles. It is advisable to contact the uploader of the samples in question for confirmation.')
+        faqs += qna('What is the "Multi-variant co-occurrence" option?',
+                    'GeniePool enables you to look for specific samples that have two or more different variants. To use this options, specific variants must be written in a chr:pos-ref-alt pattern and not a range, e.g. chr1:12345-A-C; several variants can be entered in each field, separated by ";", e.g. chr1:12345-A-C;chr2:2000-C-G. Carriers can be restricted to heterozygous or homozygous calls of every variant.')
+        faqs += qna('Is the "Multi-variant co-occurrence" option suitable for finding compound-heterozygotes?',
+                    'Yes and no. While you may be able to find samples with all input variants using the "Multi-variant co-occurrence" option, it does not guarantee that they are on different alleles. It is advisable to contact the uploader of the samples in question for confirmation.')
         faqs += qna('Why results don\'t include allele frequency for a variant from the GeniePool database?',
                    'While GeniePool contains data from many individuals, the data are derived from diverse studies that may have overrepresented data (e.g. shared samples or sequencing of multiple tumors from the same patient). Therefore, GeniePool should be used to assess whether a variant was previously found in a yes/no manner, and not to assess its frequency.')
         docs = html.Div([html.Span('Yes - you are welcome to check out its '),
@@ -471,10 +532,9 @@ def searchButtonAvailabilityStatus(value, value2, mode, reference):
                 if len(value) > 2:
                     if value[2:].isdigit():
                         return [False, value, None]
-            if value.upper() in geneNames:
-                gene = value.upper()
-                value = genes_to_coordinates.query('Gene == @gene')[reference].values[0]
-                return [False, value, None]
+            gene_coordinates = geneIndex.lookup(value, reference)
+            if gene_coordinates != None:
+                return [False, gene_coordinates, None]
             chromosome, positions = value.split(':')
             positions = [position.strip().replace(' ','').replace(',','') for position in positions.split('-')]
             if chromosome.upper().replace('MT','M').replace('CHR','') not in chromosomes:
@@ -494,25 +554,36 @@ def searchButtonAvailabilityStatus(value, value2, mode, reference):
         except:
             return [True, value, None]
     else:
-        for v in (value, value2):
-            try:
-                v = v.strip()
-                chromosome = v.split(':')[0].upper().replace('MT','M').replace('CHR','')
-                if chromosome not in chromosomes:
-                    return [True, value, None]
-                pos = v.split(':')[1].split('-')[0]
-                if pos.isdigit() == False:
-                    return [True, value, None]
-                ref = str(v.split('-')[1])
-                alt = str(v.split('-')[2])
-                change = ref + alt
-                if False in [i in 'ACTG' for i in change]:
-                    return [True, value, None]
-            except:
+        try:
+            variants = parseVariants(value) + parseVariants(value2)
+        except:
+            return [True, value, None]
+        if len(variants) < 2:
+            return [True, value, None]
+        for chromosome, position, ref, alt in variants:
+            if chromosome not in chromosomes:
+                return [True, value, None]
+            if len(ref + alt) == 0 or False in [i in 'ACTG' for i in ref + alt]:
                 return [True, value, None]
         return [False, value, value2]
 
 
+@server.route('/autocomplete')
+def autocomplete():
+    prefix = flask.request.args.get('q', '')
+    limit = min(flask.request.args.get('n', 10, type = int), 50)
+    return flask.jsonify(geneIndex.complete(prefix, limit))
+
+@app.callback(
+    [Output('gene_suggestions', 'children')],
+    [Input('coordinates', 'value')]
+)
+def suggestGenes(value):
+    if value == None or len(value.strip()) < 2 or ':' in value or value.lower().startswith('rs'):
+        return [[]]
+    return [[html.Option(value = i['gene']) for i in geneIndex.complete(value, 10)]]
+
+
 # In[ ]:
 
 
@@ -526,47 +597,51 @@ def alphaMissenseScore(AlphaMissense):
         result = 'AlphaMissense score = ' + str(AlphaMissense) + ' - Likely benign'
     return result
 
-def generateToolTip(text, coordinate, variant, AlphaMissense):
-    if 'missense' in text.lower() and AlphaMissense != '':
-        chromosome, position = coordinate.split(':')
-        return text + '\n\n' + alphaMissenseScore(AlphaMissense)
+def generateToolTip(impact, AlphaMissense):
+    if 'missense' in impact.lower() and AlphaMissense != '':
+        return impact + '\n\n' + alphaMissenseScore(AlphaMissense)
     else:
-        return text
-
-def annotateAlphaMissense(impact, AlphaMissense):
-    if 'missense' not in impact.lower() or AlphaMissense == '':
         return impact
-    else:
-        AlphaMissense = float(AlphaMissense)
-        if AlphaMissense >= 0.564:
-            return impact + ' 🔴'
-        elif AlphaMissense >= 0.34:
-            return impact + ' 🟡'
-        else:
-            return impact + ' 🟢'
-        
 
-def generateDataTable(df):
-    df['dbSNP'] = df['dbSNP'].apply(lambda x : '' if len(x) == 0 else '[' + x + '](https://www.ncbi.nlm.nih.gov/snp/' + x + ')')
-    df['Impact'] = df.apply(lambda x : annotateAlphaMissense(x['Impact'], x['AlphaMissense']), axis = 1)
-    def calculateFrequency(an, ac):
-        if an == 0:
-            return 0
-        else:
-            return round(ac/an*100,6)
-    df['gnomAD frequency'] = df.apply(lambda x : calculateFrequency(x['gnomad_an'], x['gnomad_ac']), axis = 1)
+def formatTable(df):
+    dbSNP = df['dbSNP'].astype(str)
+    df['dbSNP'] = np.where(dbSNP.str.len() == 0, '', '[' + dbSNP + '](https://www.ncbi.nlm.nih.gov/snp/' + dbSNP + ')')
+    AlphaMissense = pd.to_numeric(df['AlphaMissense'], errors = 'coerce').to_numpy()
+    missense = df['Impact'].astype(str).str.lower().str.contains('missense', regex = False).to_numpy() & ~np.isnan(AlphaMissense)
+    badges = np.select([AlphaMissense >= 0.564, AlphaMissense >= 0.34], [' 🔴', ' 🟡'], ' 🟢')
+    df['Impact'] = df['Impact'].astype(str) + np.where(missense, badges, '')
+    an = pd.to_numeric(df['gnomad_an'], errors = 'coerce').fillna(0).to_numpy()
+    ac = pd.to_numeric(df['gnomad_ac'], errors = 'coerce').fillna(0).to_numpy()
+    df['gnomAD frequency'] = np.round(np.divide(ac, an, out = np.zeros(len(df)), where = an != 0) * 100, 6)
     df = df.rename(columns={'gnomad_nhomalt': 'gnomAD homozygotes'})
+    df['row'] = range(len(df))
+    return df
+
+def pageRecords(df):
+    # Rows of a table page as sent to the browser: the displayed columns, without the sample lists.
+    return df[tableColumns + ['row']].to_dict('records')
+
+def pageTooltips(df):
+    # Only Impact has a tooltip, carrying the AlphaMissense score of missense variants.
+    return [{'Impact': {'value': generateToolTip(impact, AlphaMissense), 'type': 'markdown'}}
+            for impact, AlphaMissense in zip(df['Impact'].tolist(), df['AlphaMissense'].tolist())]
+
+def generateDataTable(view):
+    firstPage, pageCount = page(view, 0)
     ddt = dash_table.DataTable(
         id = 'table',
-        data = df.to_dict('records'),
-        columns = [{'id': c, 'name': c, 'presentation': 'markdown'} if c == 'dbSNP' else {'id': c, 'name': c} for c in ['Coordinate','Variant','Homozygotes','Heterozygotes','Impact', 'gnomAD frequency', 'gnomAD homozygotes','dbSNP']],
-        sort_action = 'native',
+        data = pageRecords(firstPage),
+        columns = [{'id': c, 'name': c, 'presentation': 'markdown'} if c == 'dbSNP' else {'id': c, 'name': c} for c in tableColumns],
+        sort_action = 'custom',
         sort_mode = 'single',
+        sort_by = [],
         row_selectable = 'single',
-        page_action = 'native',
+        page_action = 'custom',
         page_current = 0,
         page_size = 25,
-        filter_action='native',
+        page_count = pageCount,
+        filter_action='custom',
+        filter_query = '',
         filter_options={"case": "insensitive"},
         css=[
             {
@@ -581,12 +656,7 @@ def generateDataTable(df):
             'textOverflow': 'ellipsis',
             'maxWidth': 0
         },
-        tooltip_data=[
-            {
-                column: {'value': generateToolTip(str(value), row['Coordinate'], row['Variant'], row['AlphaMissense']), 'type': 'markdown'}
-                for column, value in row.items()
-            } for row in df.to_dict('records')
-        ],
+        tooltip_data = pageTooltips(firstPage),
         tooltip_duration=None,
         style_data_conditional=[
             {
@@ -633,80 +703,149 @@ def generateDataTable(df):
     )
     return ddt
 
-def listVariants(chromosome, position, mutations):
-    lines = []
-    coordinate = chromosome + ':' + str(position)
-    for mutation in mutations:
-        ref = mutation['ref']
-        alt = mutation['alt']
-        
-        dbSNP = ''
-        if 'dbSNP' in mutation.keys():
-            if mutation['dbSNP'].startswith('rs'):
-                dbSNP = mutation['dbSNP']
-        
-        AlphaMissense = ''
-        if 'alphamissense' in mutation.keys():
-            AlphaMissense = mutation['alphamissense']
-        hg38_coordinate = ''
-        if 'hg38_coordinate' in mutation.keys():
-            hg38_coordinate = mutation['hg38_coordinate']
-        
-        variant = ref + '>' + alt
-        homs = mutation['hom']
-        hets = mutation['het']
-        try:
-            impact = mutation['impact']
-        except:
-            impact = ''
-        try:
-            gnomad_an = mutation['gnomad_an']
-        except:
-            gnomad_an = 0
-        try:
-            gnomad_ac = mutation['gnomad_ac']
-        except:
-            gnomad_ac = 0
+def genesInRange(referenceGenome, chromosome, start, end, limit = 20):
+    genes = geneIntervals.overlapping(referenceGenome, chromosome, start, end)
+    if len(genes) == 0:
+        return None
+    label = ', '.join(genes[:limit])
+    if len(genes) > limit:
+        label += ' and ' + str(len(genes) - limit) + ' more'
+    return html.P('Genes in range: ' + label, style = {'font-family' : 'gisha'})
+
+def getAttributes(rowNumbers, codes, nRows):
+    facets = attributeIndex.facetCounts(rowNumbers, codes, nRows)
+    facets = facets[~facets['Attribute'].str.startswith(('ENA ', 'DNA-ID', 'ENA-', 'External Id', 'INSDC'))]
+    return facets.sort_values('Attribute')
+
+
+def buildView(search, minQual, minCoverage):
+    # Formatted table of a stored search at the given thresholds; the last one is kept with the search.
+    thresholds, view = search.get('view', (None, None))
+    if thresholds == (minQual, minCoverage):
+        return view
+    df = search['calls'].table(minQual, minCoverage)
+    if search['reference'] != 'chm13v2':
+        del df['hg38_coordinate']
+    df['Gene'] = geneIntervals.annotate(search['reference'], df['Coordinate'])
+    view = formatTable(df)
+    search['view'] = ((minQual, minCoverage), view)
+    return view
+
+def searchView(token, minQual, minCoverage):
+    search = resultStore.get(token) if token != None else None
+    if search == None:
+        return None, None
+    return search, buildView(search, minQual, minCoverage)
+
+def tableView(search, view, minQual, minCoverage, chosen_attributes, filter_query, sort_by):
+    # Rows of `view` the table shows for the given attributes, filter_query and sort_by
+    if chosen_attributes not in (None, []):
+        rowNumbers, codes = search['calls'].calls(minQual, minCoverage)
+        view = view[attributeIndex.rowsWithAny(rowNumbers, codes, len(view), chosen_attributes)]
+    return sortFrame(filterFrame(view, filter_query), sort_by)
+
+def exportLinks(token, minQual, minCoverage, filter_query = None, sort_by = None, chosen_attributes = None):
+    # Download links for the table as it is shown
+    parameters = [('qual', minQual or 0), ('coverage', minCoverage or 0)]
+    if filter_query not in (None, ''):
+        parameters.append(('filter', filter_query))
+    parameters += [('sort', i['column_id'] + ':' + i['direction']) for i in sort_by or []]
+    parameters += [('attribute', attribute) for attribute in chosen_attributes or []]
+    return [html.A(label, href = '/export/' + token + '?' + urlencode([('format', exportFormat)] + parameters), download = 'GeniePool.' + exportFormat, style = download_style)
+            for label, exportFormat in (('CSV', 'csv'), ('TSV', 'tsv'), ('Parquet', 'parquet'), ('VCF', 'vcf'))]
+
+def renderResults(search, token, minQual, minCoverage):
+    # -> (table_div children, variant count) of the stored search `token` at the given thresholds
+    variantCalls = search['calls']
+    referenceGenome = search['reference']
+    commonSamples = None
+    if search['mode'] != 'Single':
+        commonSamples = coOccurrence.common(variantCalls, search['zygosity'], minQual, minCoverage)
+    view = buildView(search, minQual, minCoverage)
+    if view.empty or (commonSamples != None and len(commonSamples) == 0):
+        return [html.P('No results')], None
+    ddt = generateDataTable(view)
+    info = html.Div(id = 'info', style = info_style)
+    download_btn = html.Div(
+        [html.Span('Download: ', style = {'font-family' : 'gisha', 'padding' : 8}),
+         html.Span(exportLinks(token, minQual, minCoverage), id = 'exportLinks')],
+        style = {'float' : 'right', 'marginTop' : 1}
+    )
+    rowNumbers, codes = variantCalls.calls(minQual, minCoverage)
+    attributes = getAttributes(rowNumbers, codes, len(view))
+    explanation = 'The attributes are tags that characterize each sample on its BioSample page. Only variants associated with at least one sample that exhibits one or more of the selected attributes will be retained. The counts next to each attribute are the samples carrying it and the variants that would be retained.'
+    phenoPicker = html.Div(
+        dcc.Dropdown(
+            id = 'phenoPicker',
+            options = [{'label': a + ' (' + '{:,}'.format(n_samples) + ' samples, ' + '{:,}'.format(n_variants) + ' variants)', 'value': a} for a, n_samples, n_variants in attributes.itertuples(index = False)],
+            multi = True,
+            placeholder = 'Select attributes ℹ️',
+        ),
+        title = explanation,
+        style = {
+            'width': '100%',
+            'marginTop': '10px',
+            'marginLeft': '10px',
+            'marginRight': '10px',
+            'font-family' : 'gisha',
+            'marginLeft':'auto',
+            'marginRight':'auto',
+            'display' : 'inline-block'
+        }
+    ) 
+    result = [phenoPicker, ddt, download_btn, info]
+    if search['start'] != None:
+        genes = genesInRange(referenceGenome, search['chromosome'], search['start'], search['end'])
+        if genes != None:
+            result = [genes] + result
+    if commonSamples != None:
+        header = [html.P('Samples with all ' + str(len(variantCalls)) + ' variants: (' + str(len(commonSamples)) + ')')]
+        compounds = []
+        for sample in commonSamples:
+            compounds += [html.A(sample, href = 'https://www.ncbi.nlm.nih.gov/sra/' + sample, target = '_blank'), html.Span(', ')]
+        result = header + [html.P(compounds[:-1])] + result
+    return result, search['variantNumber']
+
+def runSearch(referenceGenome, mode, zygosity, variantsInput, coordinates2, filters):
+    # -> (search to store, None) or (None, message to show instead of results). The search keeps its
+    # input and filters, so it can be repeated with other thresholds.
+    coordinates = variantsInput.upper().replace(' ', '').replace(',','').replace('CHR','').replace('MT','').strip()
+    search = {'reference' : referenceGenome, 'mode' : mode, 'zygosity' : zygosity, 'chromosome' : None, 'start' : None, 'end' : None,
+              'input' : variantsInput, 'input2' : coordinates2, 'filters' : filters}
+    if mode == 'Single':
+        if coordinates.lower().strip().startswith('rs'):
+            if regionSearch.mirror:
+                # The partitions are not indexed by rsID; only the API resolves them.
+                return None, 'rsID search needs the GeniePool API, which this server does not use - please search by coordinates or gene symbol.'
+            coordinates = coordinates.lower().strip()
+            df, variantNumber, chromosome = regionSearch.variantId(referenceGenome, coordinates, filters)
+        else:
+            chromosome = coordinates.split(':')[0]
+            pos = coordinates.split(':')[1]
+            start, end = int(pos.split('-')[0]), int(pos.split('-')[1])
+            try:
+                df, variantNumber = regionSearch.region(referenceGenome, chromosome, start, end, filters)
+            except TimeoutError:
+                return None, 'The search took too long - please try again or narrow the range.'
+        if df.empty:
+            return None, 'No results'
+        search['calls'] = VariantResult.fromRows(chromosome, df)
+        if coordinates.startswith('rs') == False:
+            search.update({'chromosome' : chromosome, 'start' : start, 'end' : end})
+    else:
         try:
-            gnomad_nhomalt = mutation['gnomad_nhomalt']
+            variants = parseVariants(variantsInput) + parseVariants(coordinates2)
+            mutations, variantCalls = coOccurrence.search(referenceGenome, variants, filters)
+        except TimeoutError:
+            return None, 'The search took too long - please try again with fewer variants.'
         except:
-            gnomad_nhomalt = 0
-        #print(coordinate, variant, homs, hets, impact, dbSNP, AlphaMissense, gnomad_an, gnomad_ac, gnomad_nhomalt, hg38_coordinate)
-        lines.append([coordinate, variant, homs, hets, impact, dbSNP, AlphaMissense, gnomad_an, gnomad_ac, gnomad_nhomalt, hg38_coordinate])
-    return lines
-
-def geneToCoordinates(gene, referenceGenome):
-    df = pd.read_csv('assets/' + referenceGenome + '_genes_to_coordinates.csv')
-    coordinates = df[df['Gene'] == gene]['Coordinates'].values[0]
-    return coordinates
-
-def getAttributes(relevant_samples):
-    relevant_samples = [[j['id'] for j in i] for i in relevant_samples]
-    relevant_samples = set([item for sublist in relevant_samples for item in sublist])
-    attributes_df = pd.read_parquet('assets/attributes.parquet')
-    attributes = attributes_df[attributes_df['Run'].isin(relevant_samples)]['Attributes'].tolist()
-    attributes = set([item for sublist in attributes for item in sublist])
-    return attributes
-
-def queryS3(x, pos_range):
-    uri = 's3://genetics-repo/' + x['version'] + '/' + x['reference'] + '/chrom=chr' + x['chromosome'] + '/pos_bucket=' + str(x['modulus']) + '/part-' + x['id'] + '.snappy.parquet'
-    df = pd.read_parquet(uri)
-    df = df[df['pos'].isin(pos_range)]
-    return df
-
-
-@app.callback(
-    [Output('download-dataframe-csv', 'data')],
-    [Input('btn_csv', 'n_clicks'),
-    Input('tableData', 'data')],
-    prevent_initial_call = True,
-)
-def func(n_clicks, data):
-    if n_clicks in (0, None):
-        return [dash.no_update]
-    else:
-        df = pd.DataFrame(data)
-        return [dcc.send_data_frame(df.to_csv, 'GeniePool.csv')]
+            return None, 'No results'
+        if variantCalls == None:
+            return None, 'No results'
+        variantNumber = len(mutations)
+        search['calls'] = variantCalls
+    search['variantNumber'] = variantNumber
+    return search, None
 
 @app.callback(
     [Output('table_div', 'children'),
@@ -715,24 +854,38 @@ def func(n_clicks, data):
      Output('variantNumber', 'data'),
      Output('coordinates', 'value'),
      Output('location', 'search'),
-     Output('tableData','data'),],
+     Output('searchToken', 'data'),],
     [Input('search_button', 'n_clicks'),
      Input('coordinates_value','data'),
      Input('coordinates2_value','data'),
      Input('reference_genome', 'data'),
      Input('n_click_track', 'data'),
-     Input('minQual', 'data'),
-     Input('minCoverage', 'data'),
      Input('location', 'search'),
      Input('coOccurrenceMode', 'value'),
      Input('gnomADmaxHom', 'data'),
      Input('gnomADmaxAC', 'data'),
      Input('minAlphaMissense', 'data'),
-     ]
+     Input('minQual', 'data'),
+     Input('minCoverage', 'data'),
+     ],
+    [State('coOccurrenceZygosity', 'value'),
+     State('searchToken', 'data')]
 )
-def getAPI(n_clicks, coordinates, coordinates2, referenceGenome, search_button_n_clicks, minQual, minCoverage, query, mode, gnomADmaxHom, gnomADmaxAC, minAlphaMissense):
+def getAPI(n_clicks, coordinates, coordinates2, referenceGenome, search_button_n_clicks, query, mode, gnomADmaxHom, gnomADmaxAC, minAlphaMissense, minQual, minCoverage, zygosity, token):
+    if len(dash.ctx.triggered_prop_ids) > 0 and set(dash.ctx.triggered_prop_ids.values()) <= {'minQual', 'minCoverage'}:
+        # Raised thresholds re-filter the last search's stored calls. Calls below the thresholds it was
+        # fetched at were never sent, so lowering one repeats the search.
+        search = resultStore.get(token) if token != None else None
+        if search == None:
+            return [dash.no_update] * 7
+        if (minQual or 0) < (search['filters']['qual'] or 0) or (minCoverage or 0) < (search['filters']['ad'] or 0):
+            search, failure = runSearch(search['reference'], search['mode'], search['zygosity'], search['input'], search['input2'], dict(search['filters'], qual = minQual, ad = minCoverage))
+            if failure != None:
+                return [[html.P(failure)], dash.no_update, dash.no_update, None, dash.no_update, dash.no_update, dash.no_update]
+            token = resultStore.put(search)
+        result, variantNumber = renderResults(search, token, minQual, minCoverage)
+        return [result, dash.no_update, dash.no_update, variantNumber, dash.no_update, dash.no_update, token]
     inputUpdate = dash.no_update
-    commonSamples = None
     if query.count('?') == 2:
         if n_clicks == None:
             search_button_n_clicks = 0
@@ -750,208 +903,13 @@ def getAPI(n_clicks, coordinates, coordinates2, referenceGenome, search_button_n
     if n_clicks == search_button_n_clicks:
         return [dash.no_update, dash.no_update, dash.no_update, dash.no_update, inputUpdate, '', dash.no_update]
     if n_clicks > search_button_n_clicks:
-        coordinates = coordinates.upper().replace(' ', '').replace(',','').replace('CHR','').replace('MT','').strip()
-        if mode == 'Single':
-            if coordinates.lower().strip().startswith('rs'):
-                coordinates = coordinates.lower().strip()
-            else:
-                chromosome = coordinates.split(':')[0]
-                pos = coordinates.split(':')[1]
-                start, end = int(pos.split('-')[0]), int(pos.split('-')[1])
-            try: #if end - start > -1:
-                query = 'http://api.geniepool.link/rest/index/' + referenceGenome + '/' + coordinates  + '?qual=' + str(minQual) + '&ad=' + str(minCoverage)
-                if str(gnomADmaxHom) not in ('0', 'None'):
-                    query += '&gnomad_nhomalt=' + str(gnomADmaxHom)
-                if str(gnomADmaxAC) not in ('0', 'None'):
-                    query += '&gnomad_ac=' + str(gnomADmaxAC)
-                #query = 'http://api.geniepool.link/rest/index/' + referenceGenome + '/' + coordinate
-                print(query) #shit
-                if minAlphaMissense != 0:
-                    query += '&am=' + str(minAlphaMissense)
-                print(query) #shit
-                data = requests.get(query).text 
-                data = json.loads(data)
-                if len(data) == 0:
-                    result = [html.P('No results')]
-                    return [result, n_clicks, {'display':'none'}, None, inputUpdate,'']
-                elif len(data) == 1:
-                    lines = listVariants(chromosome, coordinates.split(':')[1].replace(',','').replace(' ',''), data['entries'])
-                    variantNumber = len(lines)
-                else:
-                    variantNumber = int(data['count'])
-                    df = pd.json_normalize(data['data'])
-                    if df.empty:
-                        result = [html.P('No results')]
-                        return [result, n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
-            except: #else:
-                pos_range = range(start, end + 1)
-                modulus1, modulus2 = start//100000, end//100000
-                results = []
-                for m in range(modulus1, modulus2 + 1):
-                    expression = "reference == @referenceGenome and chromosome == @chromosome and modulus == @m"
-                    query = s3map.query(expression)
-                    query['S3'] = query.apply(lambda x : queryS3(x, pos_range), axis = 1)
-                    results += [i for i in query['S3'].tolist() if i.empty == False]
-                if len(results) == 0:
-                    result = [html.P('No results')]
-                    return [result, n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
-                df = pd.concat(results)
-                variantNumber = sum([len(i) for i in df['entries'].tolist()])
-            if coordinates.lower().strip().startswith('rs'):
-                chromosome = str(data).split("chrom': '")[1].split("'")[0].upper()
-            data = df.apply(lambda x : listVariants(chromosome, x['pos'], x['entries']), axis = 1).tolist()
-        else:
-            chromosome1 = coordinates.split(':')[0]
-            coordinate1 = coordinates.split(':')[1].split('-')[0]
-            ref1 = coordinates.split('-')[1]
-            alt1 = coordinates.split('-')[2]
-            coordinates2 = coordinates.upper().replace(' ', '').replace(',','').replace('CHR','').replace('MT','').strip()
-            chromosome2 = coordinates2.split(':')[0]
-            coordinate2 = coordinates2.split(':')[1].split('-')[0]
-            ref2 = coordinates2.split('-')[1]
-            alt2 = coordinates2.split('-')[2]
-            coordinates1 = chromosome1 + ':' + str(coordinate1) + '-' + str(coordinate1)
-            coordinates2 = chromosome2 + ':' + str(coordinate2) + '-' + str(coordinate2)
-            try: #if end - start > -1:
-                query = 'http://api.geniepool.link/rest/index/' + referenceGenome + '/' + coordinates1  + '?qual=' + str(minQual) + '&ad=' + str(minCoverage)
-                if str(gnomADmaxHom) not in ('0', 'None'):
-                    query += '&gnomad_nhomalt=' + str(gnomADmaxHom)
-                if str(gnomADmaxAC) not in ('0', 'None'):
-                    query += '&gnomad_ac=' + str(gnomADmaxAC)
-                query = 'http://api.geniepool.link/rest/index/' + referenceGenome + '/' + coordinates1
-                if minAlphaMissense != 0:
-                    query += '&am=' + str(minAlphaMissense)
-                data = requests.get(query).text
-                data = json.loads(data)
-                if len(data) == 0:
-                    result = [html.P('No results')]
-                    return [result, n_clicks, {'display':'none'}, None, inputUpdate,'']
-                elif len(data) == 1:
-                    lines = listVariants(chromosome, coordinates.split(':')[1].replace(',','').replace(' ',''), data['entries'])
-                    variantNumber = len(lines)
-                else:
-                    variantNumber = int(data['count'])
-                    df1 = pd.json_normalize(data['data'])
-                    df1 = df1[df1['entries'].apply(lambda x : "'ref': 'refX', 'alt': 'altX'".replace('refX', ref1).replace('altX', alt1) in str(x))]
-                    if df1.empty:
-                        result = [html.P('No results')]
-                        return [result, n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
-                    samples1 = [j for j in [i for i in df1['entries'].tolist()[0]] if (j['ref'] == ref1) and (j['alt'] == alt1)][0]
-                    samples1 = [i['id'] for i in samples1['het']] + [i['id'] for i in samples1['hom']]
-                sleep(1)
-                query = 'http://api.geniepool.link/rest/index/' + referenceGenome + '/' + coordinates2  + '?qual=' + str(minQual) + '&ad=' + str(minCoverage)
-                if str(gnomADmaxHom) not in ('0', 'None'):
-                    query += '&gnomad_nhomalt=' + str(gnomADmaxHom)
-                if str(gnomADmaxAC) not in ('0', 'None'):
-                    query += '&gnomad_ac=' + str(gnomADmaxAC)
-                query = 'http://api.geniepool.link/rest/index/' + referenceGenome + '/' + coordinates2
-                if minAlphaMissense != 0:
-                    query += '&am=' + str(minAlphaMissense)
-                data = requests.get(query).text
-                data = json.loads(data)
-                if len(data) == 0:
-                    result = [html.P('No results')]
-                    return [result, n_clicks, {'display':'none'}, None, inputUpdate,'']
-                elif len(data) == 1:
-                    lines = listVariants(chromosome, coordinates.split(':')[1].replace(',','').replace(' ',''), data['entries'])
-                    variantNumber = len(lines)
-                else:
-                    variantNumber = int(data['count'])
-                    df2 = pd.json_normalize(data['data'])
-                    df2 = df2[df2['entries'].apply(lambda x : "'ref': 'refX', 'alt': 'altX'".replace('refX', ref2).replace('altX', alt2) in str(x))]
-                    if df2.empty:
-                        result = [html.P('No results')]
-                        return [result, n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
-                    samples2 = [j for j in [i for i in df2['entries'].tolist()[0]] if (j['ref'] == ref2) and (j['alt'] == alt2)][0]
-                    samples2 = [i['id'] for i in samples2['het']] + [i['id'] for i in samples2['hom']]
-                    commonSamples = list(set(samples1).intersection(set(samples2)))
-                    if len(commonSamples) == 0:
-                        result = [html.P('No results')]
-                        return [result, n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
-                    data1 = df1.apply(lambda x : listVariants(chromosome1, x['pos'], x['entries']), axis = 1).tolist()
-                    data2 = df2.apply(lambda x : listVariants(chromosome2, x['pos'], x['entries']), axis = 1).tolist()
-                    if data1 != data2:
-                        data = data1 + data2
-                    else:
-                        data = data1
-            except:
-                result = [html.P('No results')]
-                return [result, n_clicks, {'display':'none'}, None, inputUpdate,'', dash.no_update]
-        lines = []
-        for mutation in data:
-            for line in mutation:
-                hets = line[2]
-                if len(hets) > 0:
-                    legitHets = [i for i in hets if sum([int(v) for v in i['ad'].split(',')]) >= minCoverage and int(i['qual']) >= minQual]
-                else :
-                    legitHets = []
-                homs = line[3]
-                if len(homs) > 0:
-                    legitHoms = [i for i in homs if sum([int(v) for v in i['ad'].split(',')]) >= minCoverage and int(i['qual']) >= minQual]
-                else:
-                    legitHoms = []
-                if len(legitHets + legitHoms) != 0:
-                    line[2] = legitHets
-                    line[3] = legitHoms
-                    lines += [line]
-        if len(lines) == 0:
-            result = [html.P('No results')]
-            return [result, n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
-        df = pd.DataFrame(lines, columns = ['Coordinate', 'Variant', 'Homozygote Samples', 'Heterozygote Samples', 'Impact', 'dbSNP', 'AlphaMissense', 'gnomad_an', 'gnomad_ac', 'gnomad_nhomalt', 'hg38_coordinate'])
-        if referenceGenome != 'chm13v2':
-            del df['hg38_coordinate']
-        df['Homozygotes'] = df['Homozygote Samples'].str.len()
-        df['Heterozygotes'] = df['Heterozygote Samples'].str.len()
-        if commonSamples != None:
-            df = df[df['Variant'].isin([ref1 + '>' + alt1, ref2 + '>' + alt2])]
-            df = df[df['Coordinate'].isin([coordinates1.split('-')[0], coordinates2.split('-')[0]])]
-        ddt = generateDataTable(df)
-        info = html.Div(id = 'info', style = info_style)
-        bty_style = {
-            'marginTop': '1',
-            'font-family' : 'gisha',
-            'marginRight': 3,
-            'float': 'right',
-            'fontSize': '100%',
-            'padding' : 8,
-            'display' : 'inline-block',
-            'text-decoration' : 'none',
-            'backgroundColor' : 'white',
-            'border-radius' : 10
-        }
-        download_btn = html.Button('Download table', id = 'btn_csv', style = bty_style) #{'text-decoration' : 'none', 'fontSize' : '80%', 'float' : 'right', 'marginTop' : 1})
-        samples = [i for i in df['Homozygote Samples'] if len(i) > 0] + [i for i in df['Heterozygote Samples'] if len(i) > 0]
-        attributes = getAttributes(samples)
-        for v in ('ENA ', 'DNA-ID', 'ENA-', 'External Id', 'INSDC'):
-            attributes = [i for i in attributes if i.startswith(v) == False]
-        explanation = 'The attributes are tags that characterize each sample on its BioSample page. Only variants associated with at least one sample that exhibits one or more of the selected attributes will be retained.'
-        phenoPicker = html.Div(
-            dcc.Dropdown(
-                id = 'phenoPicker',
-                options = [{'label': v, 'value': v} for v in sorted(attributes, reverse = False)],
-                multi = True,
-                placeholder = 'Select attributes ℹ️',
-            ),
-            title = explanation,
-            style = {
-                'width': '100%',
-                'marginTop': '10px',
-                'marginLeft': '10px',
-                'marginRight': '10px',
-                'font-family' : 'gisha',
-                'marginLeft':'auto',
-                'marginRight':'auto',
-                'display' : 'inline-block'
-            }
-        ) 
-        result = [phenoPicker, ddt, download_btn, info]
-        if commonSamples != None:
-            header = [html.P('Samples with both variants: (' + str(len(commonSamples)) + ')')]
-            compounds = []
-            for sample in commonSamples:
-                compounds += [html.A(sample, href = 'https://www.ncbi.nlm.nih.gov/sra/' + sample, target = '_blank'), html.Span(', ')]
-            result = header + [html.P(compounds[:-1])] + result
-        return [result, n_clicks, {'display':'none'}, variantNumber, inputUpdate, '', df.to_dict('records')]
+        filters = {'qual' : minQual, 'ad' : minCoverage, 'gnomadNhomalt' : gnomADmaxHom, 'gnomadAc' : gnomADmaxAC, 'am' : minAlphaMissense}
+        search, failure = runSearch(referenceGenome, mode, zygosity, coordinates, coordinates2, filters)
+        if failure != None:
+            return [[html.P(failure)], n_clicks, {'display':'none'}, None, inputUpdate, '', dash.no_update]
+        token = resultStore.put(search)
+        result, variantNumber = renderResults(search, token, minQual, minCoverage)
+        return [result, n_clicks, {'display':'none'}, variantNumber, inputUpdate, '', token]
     else:
         return [None, n_clicks, dash.no_update, None, inputUpdate, '', dash.no_update]
 
@@ -962,9 +920,10 @@ def getAPI(n_clicks, coordinates, coordinates2, referenceGenome, search_button_n
 def generateSamplesTable(df):
     df = df[['BioSample', 'Run', 'QUAL', 'Coverage']]
     df.columns = ['BioSample', 'SRA', 'Read Quality Score', 'Coverage (altered/total reads)']
-    df['BioSample'] = df['BioSample'].apply(lambda x : '[' + x + '](https://www.ncbi.nlm.nih.gov/biosample/' + x + ')')
-    df['SRA'] = df['SRA'].apply(lambda x : '[' + x + '](https://www.ncbi.nlm.nih.gov/sra/' + x + ')')
-    df['Coverage (altered/total reads)'] = df['Coverage (altered/total reads)'].apply(lambda x : str(x.split(',')[1]) + '/' + str(int(x.split(',')[0]) +  int(x.split(',')[1])))
+    df['BioSample'] = '[' + df['BioSample'] + '](https://www.ncbi.nlm.nih.gov/biosample/' + df['BioSample'] + ')'
+    df['SRA'] = '[' + df['SRA'] + '](https://www.ncbi.nlm.nih.gov/sra/' + df['SRA'] + ')'
+    depths = df['Coverage (altered/total reads)'].str.split(',', expand = True).astype(int)
+    df['Coverage (altered/total reads)'] = depths[1].astype(str) + '/' + (depths[0] + depths[1]).astype(str)
     table = dash_table.DataTable(
         data = df.to_dict('records'),
         columns = [{'id': c, 'name': c, 'presentation': 'markdown'} if c in ('BioSample', 'SRA') else {'id': c, 'name': c} for c in df.columns],
@@ -1020,15 +979,61 @@ def generateStudyBlock(study, homsInStudy, hetsInStudy):
     studyDivObject.append(html.Br())
     return studyDivObject
 
+def variantCarriers(search, row):
+    # Carriers of row `row` of the search's current view, joined to the study table in one pass and
+    # ordered by study size -> (carriers, studies, {study: (start, end) of its carriers}). The last
+    # one is kept with the search for the study callbacks.
+    key = (search['view'][0], row)
+    cached = search.get('carriers')
+    if cached != None and cached[0] == key:
+        return cached[1]
+    variant = search['view'][1].iloc[row]
+    calls = np.empty(len(variant['Homozygote Samples']) + len(variant['Heterozygote Samples']), dtype = object)
+    calls[:] = list(variant['Homozygote Samples']) + list(variant['Heterozygote Samples'])
+    hom = np.arange(len(calls)) < len(variant['Homozygote Samples'])
+    # a run listed under several studies is a carrier in each of them
+    known, rows = studyIndex.rowsOf(sampleDictionary.encode([call['id'] for call in calls]))
+    ranked, rank = studyIndex.rank(rows)
+    order = np.argsort(rank, kind = 'stable')
+    rows, known, rank = rows[order], known[order], rank[order]
+    studies = studyIndex.titles(ranked)
+    carriers = pd.DataFrame({
+        'BioSample' : studyIndex.bioSamplesOf(rows),
+        'Run' : [call['id'] for call in calls[known]],
+        'QUAL' : [call['qual'] for call in calls[known]],
+        'Coverage' : [call['ad'] for call in calls[known]],
+        'Homozygote' : hom[known],
+        'rank' : rank,
+    })
+    bounds = np.searchsorted(rank, np.arange(len(studies) + 1))
+    result = (carriers, studies, dict(zip(studies, zip(bounds[:-1], bounds[1:]))))
+    search['carriers'] = (key, result)
+    return result
+
+def selectedCarriers(token, minQual, minCoverage, row):
+    search, view = searchView(token, minQual, minCoverage)
+    if view is None or row == None or row >= len(view):
+        return None
+    return variantCarriers(search, row)
+
+def studyBlock(carriers, bounds, study, style = study_style):
+    start, end = bounds[study]
+    inStudy = carriers.iloc[start:end]
+    homozygote = inStudy['Homozygote'].to_numpy()
+    return html.Div(generateStudyBlock(study, inStudy[homozygote], inStudy[~homozygote]), style = style)
+
 @app.callback(
     [Output('info', 'children'),
-     Output('studiesDict', 'data')],
+     Output('selectedVariant', 'data')],
     [Input('table', 'derived_virtual_selected_rows'),
      Input('table', 'derived_virtual_data'),
      Input('referenceRadioButtons', 'value'),
-     Input('variantNumber', 'data')]
+     Input('variantNumber', 'data')],
+    [State('searchToken', 'data'),
+     State('minQual', 'data'),
+     State('minCoverage', 'data')]
 )
-def getVariantData(selected_row_index, data, referenceGenome, variantNumber):
+def getVariantData(selected_row_index, data, referenceGenome, variantNumber, token, minQual, minCoverage):
     if selected_row_index in [[], None, None]:
         variantLimit = 1000
         if variantNumber > variantLimit:
@@ -1043,17 +1048,18 @@ def getVariantData(selected_row_index, data, referenceGenome, variantNumber):
         instructions_gif = html.Img(src = 'assets/click_demo.gif')
         return [[instructions, instructions_gif], None]
     else:
-        coordinates = data[selected_row_index[0]]['Coordinate']
-        mutation = data[selected_row_index[0]]['Variant']
-        homozygotesData = data[selected_row_index[0]]['Homozygote Samples']
-        homozygotes = {i['id'] : {'qual' : i['qual'], 'coverage' : i['ad']} for i in homozygotesData}
-        heterozygotesData = data[selected_row_index[0]]['Heterozygote Samples']
-        heterozygotes = {i['id'] : {'qual' : i['qual'], 'coverage' : i['ad']} for i in heterozygotesData}
+        _, view = searchView(token, minQual, minCoverage)
+        if view is None:
+            return [html.P('This search has expired - please search again.', style = {'font-family' : 'gisha'}), None]
+        rowNumber = data[selected_row_index[0]]['row']
+        row = view.iloc[rowNumber]
+        coordinates = row['Coordinate']
+        mutation = row['Variant']
         infoWindow = []
         
         ucsc_link = 'https://genome.ucsc.edu/cgi-bin/hgTracks?db=' + referenceGenome + '&position=' + coordinates.replace(':','%3A')
         if referenceGenome == 'chm13v2':
-            hg38_coordinate = data[selected_row_index[0]]['hg38_coordinate']
+            hg38_coordinate = row['hg38_coordinate']
             ucsc_link = 'https://genome.ucsc.edu/cgi-bin/hgTracks?db=hub_3671779_hs1&position=' + hg38_coordinate
         ucscA = html.A('UCSC', href = ucsc_link, target = '_blank', style = link_style)
         
@@ -1069,16 +1075,12 @@ def getVariantData(selected_row_index, data, referenceGenome, variantNumber):
         gnomADLink = html.A('gnomAD',target='_blank', href = gnomAD_Url, style = link_style)
         infoWindow.append(html.Div([html.P(''), ucscA, html.Span('    '), gnomADLink, html.P('')]))
         
-        variant_df = SRA_studies_and_samples[SRA_studies_and_samples['Run'].isin(list(homozygotes.keys()) + list(heterozygotes.keys()))]
-        studies_counts = variant_df['Study Title'].value_counts(sort = True)
-        sorting_dict = {i : n for n, i in enumerate(studies_counts.index)}
-        variant_df.sort_values(by=['Study Title'], key=lambda x: x.map(sorting_dict), inplace = True)
-        variant_df.reset_index(drop = True, inplace = True)
-        homs_df = variant_df[variant_df['Run'].isin(homozygotes.keys())]
-        hets_df = variant_df[variant_df['Run'].isin(heterozygotes.keys())]
-        homs_studies_counts = homs_df['Study Title'].value_counts()
-        hets_studies_counts = hets_df['Study Title'].value_counts()
-        
+        carriers, studies, bounds = selectedCarriers(token, minQual, minCoverage, rowNumber)
+        rank, homozygote = carriers['rank'].to_numpy(), carriers['Homozygote'].to_numpy()
+        homs_studies_counts = pd.Series(np.bincount(rank[homozygote], minlength = len(studies)), index = studies)
+        hets_studies_counts = pd.Series(np.bincount(rank[~homozygote], minlength = len(studies)), index = studies)
+        homs_studies_counts, hets_studies_counts = homs_studies_counts[homs_studies_counts > 0], hets_studies_counts[hets_studies_counts > 0]
+
         xlabel = 'Click bars for specific information about studies'
         
         fig = go.Figure(
@@ -1105,80 +1107,108 @@ def getVariantData(selected_row_index, data, referenceGenome, variantNumber):
         infoWindow.append(graph)
         infoWindow.append(html.Div(id = 'navigatorDiv'))
         
-        displayLinks = True
-        if len(studies_counts) > 1000:
-            infoWindow.append(html.P('Links unavialable (over 1000 studies).'))
-            return [infoWindow, None]
-        
         infoWindow.append(html.Div(id = 'clickedStudy'))
-        studiesDict = dict()
-        studyDivObjects = []
-        for study in studies_counts.index:
-            homsInStudy = homs_df[homs_df['Study Title'] == study]
-            homsInStudy['QUAL'] = homsInStudy['Run'].apply(lambda x : homozygotes[x]['qual'])
-            homsInStudy['Coverage'] = homsInStudy['Run'].apply(lambda x : homozygotes[x]['coverage'])
-            hetsInStudy = hets_df[hets_df['Study Title'] == study]
-            hetsInStudy['QUAL'] = hetsInStudy['Run'].apply(lambda x : heterozygotes[x]['qual'])
-            hetsInStudy['Coverage'] = hetsInStudy['Run'].apply(lambda x : heterozygotes[x]['coverage'])
-            studyBlock = generateStudyBlock(study, homsInStudy, hetsInStudy)
-            studiesDict[study] = html.Div(studyBlock, style = study_style)
-            studyDivObjects.append(html.Div(studyBlock, style = study_style))
         details = html.Details([
-            html.Summary('Click on a bar to view samples from a specific study, or here for all studies (' + str(len(studies_counts.index)) + ')', style = {'fontSize' : '125%'}),
-            html.Div(html.Div(studyDivObjects))
+            html.Summary('Click on a bar to view samples from a specific study, or here for all studies (' + '{:,}'.format(len(studies)) + ')', style = {'fontSize' : '125%'}),
+            html.Div([
+                html.Button('Previous', id = 'studyPrevious', style = {'font-family' : 'gisha', 'marginRight' : 6}),
+                html.Span(id = 'studyPageLabel', style = {'font-family' : 'gisha'}),
+                html.Button('Next', id = 'studyNext', style = {'font-family' : 'gisha', 'marginLeft' : 6}),
+            ], style = {'marginTop' : 6, 'marginBottom' : 6}),
+            dcc.Store(id = 'studyPage', data = 0),
+            html.Div(id = 'studyBlocks')
         ],
         id = 'details')
         infoWindow.append(details)
-        return [infoWindow, studiesDict]
+        return [infoWindow, rowNumber]
 
 @app.callback(
     [Output('clickedStudy', 'children')],
-    [Input('study_counts_graph', 'clickData'),
-     Input('studiesDict', 'data')])
-def update_figure(clickData, studiesDict):
+    [Input('study_counts_graph', 'clickData')],
+    [State('selectedVariant', 'data'),
+     State('searchToken', 'data'),
+     State('minQual', 'data'),
+     State('minCoverage', 'data')])
+def update_figure(clickData, row, token, minQual, minCoverage):
     if clickData == None:
         return [None]
-    study = studiesDict[clickData['points'][0]['label']]
-    study['props']['style'] = {'marginBottom' : '10px', 'width' : '100%', 'paddingLeft' : '2px', 'borderColor' : 'gold','borderWidth': '4px', 'borderStyle': 'groove', 'borderRadius': '5px', 'display' : 'inline-block', 'textAlign' : 'left'}
-    return [[study]]
+    selected = selectedCarriers(token, minQual, minCoverage, row)
+    study = clickData['points'][0]['label']
+    if selected == None or study not in selected[2]:
+        return [None]
+    carriers, _, bounds = selected
+    style = {'marginBottom' : '10px', 'width' : '100%', 'paddingLeft' : '2px', 'borderColor' : 'gold','borderWidth': '4px', 'borderStyle': 'groove', 'borderRadius': '5px', 'display' : 'inline-block', 'textAlign' : 'left'}
+    return [[studyBlock(carriers, bounds, study, style)]]
+
+@app.callback(
+    [Output('studyBlocks', 'children'),
+     Output('studyPage', 'data'),
+     Output('studyPageLabel', 'children')],
+    [Input('details', 'open'),
+     Input('studyPrevious', 'n_clicks'),
+     Input('studyNext', 'n_clicks')],
+    [State('studyPage', 'data'),
+     State('selectedVariant', 'data'),
+     State('searchToken', 'data'),
+     State('minQual', 'data'),
+     State('minCoverage', 'data')],
+    prevent_initial_call = True
+)
+def getStudyPage(isOpen, previous, next, pageNumber, row, token, minQual, minCoverage):
+    # Study blocks are only built for the page being looked at, and only once the list is opened.
+    if isOpen != True:
+        return [None, dash.no_update, dash.no_update]
+    selected = selectedCarriers(token, minQual, minCoverage, row)
+    if selected == None:
+        return [html.P('This search has expired - please search again.', style = {'font-family' : 'gisha'}), 0, '']
+    carriers, studies, bounds = selected
+    if len(studies) == 0:
+        return [html.P('No samples of this variant are in a listed study.', style = {'font-family' : 'gisha'}), 0, '']
+    lastPage = max(0, (len(studies) - 1) // studiesPerPage)
+    pageNumber = pageNumber or 0
+    if dash.ctx.triggered_id == 'studyPrevious':
+        pageNumber = max(0, pageNumber - 1)
+    elif dash.ctx.triggered_id == 'studyNext':
+        pageNumber = min(lastPage, pageNumber + 1)
+    first = pageNumber * studiesPerPage
+    shown = studies[first:first + studiesPerPage]
+    label = 'Studies ' + '{:,}'.format(first + 1) + '-' + '{:,}'.format(first + len(shown)) + ' of ' + '{:,}'.format(len(studies))
+    return [[studyBlock(carriers, bounds, study) for study in shown], pageNumber, label]
 
 
 # In[ ]:
 
 
-def extractSamples(samples):
-    return re.findall(r"'id': '(.*?)'", str(samples))
-    
 @app.callback(
-    [Output('table', 'data')],
-    [Input('phenoPicker', 'value'),
-    Input('tableData', 'data')]
+    [Output('table', 'data'),
+     Output('table', 'page_count'),
+     Output('table', 'tooltip_data'),
+     Output('table', 'selected_rows'),
+     Output('table', 'page_current'),
+     Output('exportLinks', 'children')],
+    [Input('table', 'page_current'),
+     Input('table', 'page_size'),
+     Input('table', 'sort_by'),
+     Input('table', 'filter_query'),
+     Input('phenoPicker', 'value')],
+    [State('searchToken', 'data'),
+     State('minQual', 'data'),
+     State('minCoverage', 'data')],
+    prevent_initial_call = True
 )
-def getRelevantVariants(chosen_attributes, data):
-    if chosen_attributes == None:
-        return [dash.no_update]
-    elif len(chosen_attributes) == 0:
-        return [pd.DataFrame(data).to_dict('records')]
-    chosen_attributes = set(chosen_attributes)
-    samples_in_range = pd.DataFrame(data)
-    samples_in_range = samples_in_range['Homozygote Samples'] + samples_in_range['Heterozygote Samples']
-    samples_in_range = [[j['id'] for j in i] for i in samples_in_range]
-    samples_in_range = list(set([item for sublist in samples_in_range for item in sublist]))
-    attributes_df = pd.read_parquet('assets/attributes.parquet')
-    attributes_df = attributes_df[attributes_df['Run'].isin(samples_in_range)]
-    samples = set()
-    for sample in samples_in_range:
-        try:
-            sample_attributes = set(attributes_df[attributes_df['Run'] == sample]['Attributes'].values[0])
-            if len(chosen_attributes & sample_attributes) > 0:
-                samples.add(sample)
-        except:
-            continue
-    df = pd.DataFrame(data)
-    df['samples'] = df.apply(lambda x : set(extractSamples(x['Homozygote Samples']) + extractSamples(x['Heterozygote Samples'])), axis = 1)
-    df = df[df['samples'].apply(lambda x : len(x & samples) > 0)]
-    del df['samples']
-    return [df.to_dict('records')]
+def getTablePage(page_current, page_size, sort_by, filter_query, chosen_attributes, token, minQual, minCoverage):
+    # Custom paging: the attribute, filter and sort queries run on the stored table and only the
+    # requested page is sent. A new filter or attribute selection goes back to the first page, and
+    # the page is kept within the pages left. The download links follow the table.
+    search, view = searchView(token, minQual, minCoverage)
+    if view is None:
+        return [dash.no_update] * 6
+    view = tableView(search, view, minQual, minCoverage, chosen_attributes, filter_query, sort_by)
+    if 'table.filter_query' in dash.ctx.triggered_prop_ids or 'phenoPicker.value' in dash.ctx.triggered_prop_ids:
+        page_current = 0
+    page_current = min(page_current or 0, max(0, -(-len(view) // page_size) - 1))
+    rows, pageCount = page(view, page_current, page_size)
+    return [pageRecords(rows), pageCount, pageTooltips(rows), [], page_current, exportLinks(token, minQual, minCoverage, filter_query, sort_by, chosen_attributes)]
 
 
 # In[ ]:
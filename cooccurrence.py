@@ -0,0 +1,67 @@
+# Co-occurrence of any number of chr:pos-ref-alt variants: every variant is looked up concurrently,
+# its allele is matched on ref/alt, and the carriers of all of them are found by intersecting
+# sorted sampleDictionary codes.
+
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+
+import numpy as np
+
+from indexes import sampleDictionary
+from results import VariantResult
+
+
+def parseVariants(text):
+    # 'chr1:12,345-A-C; 2:2000-C-G' -> [('1', 12345, 'A', 'C'), ('2', 2000, 'C', 'G')]
+    variants = []
+    if text == None:
+        return variants
+    for variant in re.split(r'[;\s]+', text.strip()):
+        if len(variant) == 0:
+            continue
+        variant = variant.upper().replace(',', '').replace('CHR', '')
+        chromosome, rest = variant.split(':')
+        position, ref, alt = rest.split('-')
+        variants.append((chromosome.replace('MT', 'M'), int(position), ref, alt))
+    return variants
+
+def findAllele(df, position, ref, alt):
+    for entries in df.loc[df['pos'] == position, 'entries']:
+        for mutation in entries:
+            if mutation['ref'] == ref and mutation['alt'] == alt:
+                return mutation
+    return None
+
+
+class CoOccurrence:
+
+    def __init__(self, regionSearch, maxWorkers = 8):
+        self.regionSearch = regionSearch
+        self.executor = ThreadPoolExecutor(max_workers = maxWorkers, thread_name_prefix = 'geniepool-cooccurrence')
+
+    def alleles(self, reference, variants, filters):
+        def lookup(variant):
+            chromosome, position, ref, alt = variant
+            df, _ = self.regionSearch.region(reference, chromosome, position, position, filters)
+            return findAllele(df, position, ref, alt)
+        return list(self.executor.map(lookup, variants))
+
+    def search(self, reference, variants, filters):
+        # -> (matched allele dict per variant, or None; their calls, or None if any is missing)
+        mutations = self.alleles(reference, variants, filters)
+        if None in mutations:
+            return mutations, None
+        return mutations, VariantResult.fromMutations([v[0] for v in variants], [v[1] for v in variants], mutations)
+
+    def common(self, calls, zygosity = 'any', minQual = 0, minCoverage = 0):
+        # Run accessions with a call passing the filters for every variant of `calls`
+        mask = calls.mask(minQual, minCoverage)
+        if zygosity == 'hom':
+            mask &= calls.hom
+        elif zygosity == 'het':
+            mask &= ~calls.hom
+        codes, variantIndex = calls.codes[mask], calls.variantIndex[mask]
+        arrays = [np.unique(codes[variantIndex == n]) for n in range(len(calls))]
+        common = reduce(lambda a, b : np.intersect1d(a, b, assume_unique = True), arrays)
+        return sorted(sampleDictionary.decode(common).tolist())
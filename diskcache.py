@@ -0,0 +1,201 @@
+# Byte-budgeted on-disk LRU cache shared by all workers on a host.
+# Entries are written to a temporary file and renamed into place, so readers never see partial
+# files; recency is tracked through the entry's mtime, which is refreshed on every hit. With a
+# maxAge, entries not read for that many seconds are dropped. The bytes held by the directory are
+# counted in a USAGE_FILE updated under flock by every worker, so the budget holds for the host.
+
+import fcntl
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+CACHE_DIR = os.environ.get('GENIEPOOL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'geniepool-cache'))
+CACHE_BYTES = int(os.environ.get('GENIEPOOL_CACHE_BYTES', 2 * 1024 ** 3))
+USAGE_FILE = '.usage'
+
+
+def privateDirectory(path):
+    # Creates `path` readable by this user only, or checks that an existing one is ours and not a
+    # symlink; for directories whose files are unpickled, which nobody else may be able to plant.
+    os.makedirs(path, mode = 0o700, exist_ok = True)
+    info = os.lstat(path)
+    if stat.S_ISDIR(info.st_mode) == False or info.st_uid != os.getuid():
+        raise PermissionError(path + ' is not a directory owned by this user')
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return path
+
+
+class DiskCache:
+
+    def __init__(self, directory = CACHE_DIR, maxBytes = CACHE_BYTES, lowWatermark = 0.9, maxAge = None):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lowWatermark = lowWatermark
+        self.maxAge = maxAge
+        self.lastExpiry = time.time()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = None
+        if self.enabled():
+            os.makedirs(directory, exist_ok = True)
+            self.adjustUsage(0)
+
+    def enabled(self):
+        return self.maxBytes > 0
+
+    def path(self, key):
+        digest = hashlib.sha1('\0'.join(str(i) for i in key).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    @contextmanager
+    def sharedUsage(self):
+        # Holds the flock of the shared byte count and yields [count]; the count is read from the
+        # USAGE_FILE (or from a scan of the directory the first time) and written back on exit.
+        with open(os.path.join(self.directory, USAGE_FILE), 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            usage = [int.from_bytes(data, 'little') if len(data) == 8 else self.usage()]
+            yield usage
+            f.seek(0)
+            f.truncate()
+            f.write(max(0, usage[0]).to_bytes(8, 'little'))
+            f.flush()
+        with self.lock:
+            self.bytes = max(0, usage[0])
+
+    def adjustUsage(self, delta):
+        # -> the shared byte count after adding `delta`
+        with self.sharedUsage() as usage:
+            usage[0] += delta
+        return usage[0]
+
+    def get(self, key):
+        if self.enabled() == False:
+            return None
+        path = self.path(key)
+        try:
+            if self.maxAge != None and time.time() - os.path.getmtime(path) > self.maxAge:
+                self.removeExpired([path])
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def touch(self, key):
+        # Marks the entry of `key` as used without reading it -> whether it is still there
+        if self.enabled() == False:
+            return False
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, data):
+        if self.enabled() == False or len(data) > self.maxBytes:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        descriptor, temporary = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.tmp-')
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                f.write(data)
+            # The file replaced is the one counted: its size is read and the rename done under the
+            # count's flock, so concurrent writers of a key cannot both subtract the same file.
+            with self.sharedUsage() as usage:
+                try:
+                    replaced = os.path.getsize(path)
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(temporary, path)
+                usage[0] += len(data) - replaced
+            overBudget = usage[0] > self.maxBytes
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        with self.lock:
+            expire = self.maxAge != None and time.time() - self.lastExpiry > min(self.maxAge, 60)
+            if expire:
+                self.lastExpiry = time.time()
+        if expire:
+            self.expire()
+        if overBudget:
+            self.evict()
+
+    def entries(self):
+        entries = []
+        for shard in os.scandir(self.directory):
+            if shard.is_dir() == False:
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        return entries
+
+    def usage(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # One worker evicts at a time, under the count's flock; the count is then reset from the
+        # directory, which also corrects any drift.
+        with self.sharedUsage() as usage:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            target = self.maxBytes * self.lowWatermark
+            evicted = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    evicted += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+            usage[0] = total
+        with self.lock:
+            self.evictions += evicted
+
+    def removeExpired(self, paths):
+        # Removes those of `paths` still expired, under the count's flock so that a file replaced or
+        # refreshed in the meantime is neither removed nor subtracted.
+        with self.sharedUsage() as usage:
+            for path in paths:
+                try:
+                    info = os.stat(path)
+                    if time.time() - info.st_mtime <= self.maxAge:
+                        continue
+                    os.remove(path)
+                    usage[0] -= info.st_size
+                except FileNotFoundError:
+                    pass
+
+    def expire(self):
+        expired = [path for mtime, _, path in self.entries() if time.time() - mtime > self.maxAge]
+        if len(expired) > 0:
+            self.removeExpired(expired)
+
+    def stats(self):
+        with self.lock:
+            return {'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions, 'bytes' : self.bytes, 'max_bytes' : self.maxBytes, 'pid' : os.getpid()}
@@ -0,0 +1,159 @@
+# Streaming exports of a stored search: one row per sample call as CSV, TSV or Parquet, or one
+# VCF record per variant. Output is produced CHUNK_ROWS rows at a time, so memory stays flat
+# whatever the size of the result and the first bytes go out as soon as the first chunk is ready.
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from indexes import expandRanges
+
+CHUNK_ROWS = 20000
+FORMATS = {
+    'csv' : 'text/csv',
+    'tsv' : 'text/tab-separated-values',
+    'parquet' : 'application/vnd.apache.parquet',
+    'vcf' : 'text/plain',
+}
+CALL_COLUMNS = ['Chromosome', 'Position', 'Ref', 'Alt', 'Gene', 'Impact', 'dbSNP', 'AlphaMissense', 'Run', 'Zygosity', 'Qual', 'AltDepth', 'Coverage']
+# Characters with a meaning in VCF INFO fields are percent-encoded (VCF 4.3, section 1.2).
+VCF_ESCAPES = str.maketrans({'%' : '%25', ':' : '%3A', ';' : '%3B', '=' : '%3D', ',' : '%2C', '\t' : '%09', '\n' : '%0A', '\r' : '%0D'})
+
+
+class ChunkSink:
+    # Write-only file object handing out what was written since the last take().
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def variantColumns(calls, genes):
+    # Per-variant columns of the export, split out of the table's Coordinate and Variant.
+    variants = calls.variants
+    coordinate = variants['Coordinate'].astype(str).str.rsplit(':', n = 1)
+    change = variants['Variant'].astype(str).str.split('>', n = 1)
+    return {
+        'Chromosome' : coordinate.str[0].to_numpy(dtype = object),
+        'Position' : coordinate.str[1].astype(np.int64).to_numpy(),
+        'Ref' : change.str[0].to_numpy(dtype = object),
+        'Alt' : change.str[1].to_numpy(dtype = object),
+        'Gene' : np.asarray(genes, dtype = object),
+        'Impact' : variants['Impact'].astype(str).to_numpy(dtype = object),
+        'dbSNP' : variants['dbSNP'].astype(str).to_numpy(dtype = object),
+        'AlphaMissense' : variants['AlphaMissense'].astype(str).to_numpy(dtype = object),
+    }
+
+def selectedCalls(calls, mask, variants):
+    # Positions of the calls in `mask`, of the variants `variants` in that order (all if None)
+    if variants is None:
+        return np.flatnonzero(mask)
+    indptr = np.searchsorted(calls.variantIndex, np.arange(len(calls) + 1))
+    positions, _ = expandRanges(indptr, np.asarray(variants, dtype = np.int64))
+    return positions[mask[positions]]
+
+def callFrames(calls, genes, minQual = 0, minCoverage = 0, variants = None, chunkRows = CHUNK_ROWS):
+    # One row per call passing the filters, CHUNK_ROWS rows per frame; at least one (maybe empty) frame.
+    columns = variantColumns(calls, genes)
+    selected = selectedCalls(calls, calls.mask(minQual, minCoverage), variants)
+    for start in range(0, max(len(selected), 1), chunkRows):
+        rows = selected[start:start + chunkRows]
+        variantIndex = calls.variantIndex[rows]
+        frame = {name : values[variantIndex] for name, values in columns.items()}
+        frame['Run'] = np.array([call['id'] for call in calls.records[rows]], dtype = object)
+        frame['Zygosity'] = np.where(calls.hom[rows], 'hom', 'het')
+        frame['Qual'] = calls.qual[rows]
+        frame['AltDepth'] = calls.adAlt[rows]
+        frame['Coverage'] = calls.coverage[rows]
+        yield pd.DataFrame(frame, columns = CALL_COLUMNS)
+
+def delimited(frames, separator):
+    header = True
+    for frame in frames:
+        yield frame.to_csv(sep = separator, index = False, header = header)
+        header = False
+
+def parquet(frames):
+    sink = ChunkSink()
+    writer = None
+    for frame in frames:
+        table = pa.Table.from_pandas(frame, preserve_index = False)
+        if writer == None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+def vcf(calls, genes, reference, minQual = 0, minCoverage = 0, variants = None, chunkRows = CHUNK_ROWS):
+    # Sites-only VCF: the samples of each variant go in the HOM/HET INFO fields instead of
+    # genotype columns, which would mean one column per sample of the whole result.
+    yield '\n'.join([
+        '##fileformat=VCFv4.3',
+        '##source=GeniePool',
+        '##reference=' + reference,
+        '##INFO=<ID=GENE,Number=.,Type=String,Description="Overlapping genes">',
+        '##INFO=<ID=IMPACT,Number=1,Type=String,Description="Predicted impact">',
+        '##INFO=<ID=AM,Number=1,Type=Float,Description="AlphaMissense score">',
+        '##INFO=<ID=NHOM,Number=1,Type=Integer,Description="Homozygous samples">',
+        '##INFO=<ID=NHET,Number=1,Type=Integer,Description="Heterozygous samples">',
+        '##INFO=<ID=HOM,Number=.,Type=String,Description="Runs of the homozygous samples">',
+        '##INFO=<ID=HET,Number=.,Type=String,Description="Runs of the heterozygous samples">',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO',
+    ]) + '\n'
+    columns = variantColumns(calls, genes)
+    mask = calls.mask(minQual, minCoverage)
+    homs, hets = calls.counts(mask)
+    homSamples = calls.samples(mask & calls.hom, homs)
+    hetSamples = calls.samples(mask & ~calls.hom, hets)
+    kept = np.arange(len(calls)) if variants is None else np.asarray(variants, dtype = np.int64)
+    kept = kept[homs[kept] + hets[kept] > 0]
+    for start in range(0, len(kept), chunkRows):
+        lines = []
+        for n in kept[start:start + chunkRows]:
+            info = []
+            if columns['Gene'][n] != '':
+                info.append('GENE=' + str(columns['Gene'][n]).translate(VCF_ESCAPES).replace('%2C', ','))
+            if columns['Impact'][n] != '':
+                info.append('IMPACT=' + columns['Impact'][n].translate(VCF_ESCAPES))
+            if columns['AlphaMissense'][n] != '':
+                info.append('AM=' + columns['AlphaMissense'][n])
+            info.append('NHOM=' + str(homs[n]))
+            info.append('NHET=' + str(hets[n]))
+            if homs[n] > 0:
+                info.append('HOM=' + ','.join(call['id'] for call in homSamples[n]))
+            if hets[n] > 0:
+                info.append('HET=' + ','.join(call['id'] for call in hetSamples[n]))
+            lines.append('\t'.join([columns['Chromosome'][n], str(columns['Position'][n]), columns['dbSNP'][n] or '.',
+                                    columns['Ref'][n], columns['Alt'][n], '.', 'PASS', ';'.join(info)]))
+        yield '\n'.join(lines) + '\n'
+
+def stream(exportFormat, calls, genes, reference, minQual = 0, minCoverage = 0, variants = None):
+    # `variants`: indices of the variants to export, in the order to export them (all if None)
+    if exportFormat == 'vcf':
+        return vcf(calls, genes, reference, minQual, minCoverage, variants)
+    frames = callFrames(calls, genes, minQual, minCoverage, variants)
+    if exportFormat == 'parquet':
+        return parquet(frames)
+    return delimited(frames, '\t' if exportFormat == 'tsv' else ',')
@@ -0,0 +1,371 @@
+# Indexes over the static reference tables in assets/. The tables are the ones referencedata
+# derives from the sources, already sorted and with their lookup arrays (run codes, rowOf, CSR and
+# postings) precomputed, so an index is a set of views on Arrow buffers; when those are
+# memory-mapped they are shared by every worker of the host and building an index costs next to
+# nothing whatever the size of the tables.
+
+import threading
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def column(table, name):
+    # The column `name` of `table` as a single Arrow array (a view when the table has one chunk).
+    values = table.column(name)
+    if values.num_chunks == 1:
+        return values.chunk(0)
+    return pa.concat_arrays(values.chunks) if values.num_chunks > 0 else pa.array([], type = values.type)
+
+def fixedWidth(array):
+    # fixed_size_binary Arrow array -> numpy 'S<width>' view on the same buffer
+    width = array.type.byte_width
+    return np.frombuffer(array.buffers()[1], dtype = 'S' + str(width), count = len(array), offset = array.offset * width)
+
+def expandRanges(indptr, rows):
+    # Positions of all CSR entries belonging to `rows`, in row order, plus the per-row counts.
+    starts = indptr[rows].astype(np.int64)
+    counts = indptr[rows + 1] - starts
+    offsets = np.cumsum(counts) - counts
+    positions = np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+    return positions, counts
+
+
+class SampleDictionary:
+    # Process-wide run accession -> dense integer code. The runs of the reference tables are a sorted
+    # fixed-width array (the samples table of referencedata) and their code is their position in it,
+    # the same in every worker; runs only seen in search results get the codes after those, in order
+    # of first sight. Codes never change, so code arrays from the reference tables and from searches
+    # can be compared, joined and intersected directly.
+
+    def __init__(self):
+        self.base = np.zeros(0, dtype = 'S1')
+        self.codes = {}
+        self.runs = []
+        self.decoder = np.zeros(0, dtype = object)
+        self.lock = threading.Lock()
+
+    def load(self, runs):
+        # Sets the reference runs (sorted 'S<width>' array); must come before any run is interned.
+        with self.lock:
+            if len(self.runs) > 0:
+                raise RuntimeError('Reference runs are loaded after other runs were interned')
+            self.base = runs
+
+    def __len__(self):
+        return len(self.base) + len(self.runs)
+
+    def baseCodes(self, runs):
+        # Positions of `runs` in the reference runs, -1 for the others.
+        if len(runs) == 0 or len(self.base) == 0:
+            return np.full(len(runs), -1, dtype = np.int64)
+        queries = np.char.encode(np.asarray(runs, dtype = str), 'utf-8')
+        fits = np.char.str_len(queries) <= self.base.itemsize
+        queries = queries.astype(self.base.dtype)
+        positions = np.minimum(np.searchsorted(self.base, queries), len(self.base) - 1)
+        return np.where(fits & (self.base[positions] == queries), positions, -1)
+
+    def encode(self, runs):
+        # Codes of `runs`, -1 for runs never seen.
+        codes = self.baseCodes(runs)
+        if len(self.runs) > 0:
+            for n in np.flatnonzero(codes < 0):
+                codes[n] = self.codes.get(runs[n], -1)
+        return codes
+
+    def intern(self, runs):
+        # Codes of `runs`, assigning new codes to runs never seen.
+        codes = self.encode(runs)
+        missing = np.flatnonzero(codes < 0)
+        if len(missing) > 0:
+            with self.lock:
+                for n in missing:
+                    code = self.codes.get(runs[n])
+                    if code == None:
+                        code = len(self.base) + len(self.runs)
+                        self.runs.append(runs[n])
+                        self.codes[runs[n]] = code
+                    codes[n] = code
+        return codes
+
+    def decode(self, codes):
+        codes = np.asarray(codes, dtype = np.int64)
+        runs = np.empty(len(codes), dtype = object)
+        inBase = codes < len(self.base)
+        runs[inBase] = np.char.decode(self.base[codes[inBase]], 'utf-8')
+        if inBase.all() == False:
+            with self.lock:
+                if len(self.decoder) != len(self.runs):
+                    self.decoder = np.empty(len(self.runs), dtype = object)
+                    self.decoder[:] = self.runs
+                decoder = self.decoder
+            runs[~inBase] = decoder[codes[~inBase] - len(self.base)]
+        return runs
+
+sampleDictionary = SampleDictionary()
+
+
+def rowsOf(rowOf, codes):
+    # sampleDictionary codes -> rows through a run code -> row array, -1 for runs without a row
+    rows = np.full(len(codes), -1, dtype = np.int64)
+    inRange = (codes >= 0) & (codes < len(rowOf))
+    rows[inRange] = rowOf[codes[inRange]]
+    return rows
+
+
+class AttributeIndex:
+    # Run -> attribute ids (CSR) and attribute -> runs (inverted postings).
+    # Runs are addressed by their sampleDictionary codes; selections are resolved into a boolean
+    # bitmap over the CSR rows.
+
+    def __init__(self, rowOf, attributeNames, indptr, indices, postingPtr, postingRuns):
+        self.nRuns = len(indptr) - 1
+        self.rowOf = rowOf
+        self.attributeNames = np.asarray(attributeNames, dtype = object)
+        self.attributeCodes = {name : n for n, name in enumerate(attributeNames)}
+        self.indptr = indptr
+        self.indices = indices
+        self.postingPtr = postingPtr
+        self.postingRuns = postingRuns
+
+    @classmethod
+    def fromTables(cls, tables):
+        # samples.AttributeRow, attributes.Attributes (lists of dictionary-encoded names) and
+        # attribute_postings.Rows, as made by referencedata
+        attributes = column(tables['attributes'], 'Attributes')
+        values = attributes.flatten()
+        postings = column(tables['attribute_postings'], 'Rows')
+        return cls(column(tables['samples'], 'AttributeRow').to_numpy(), values.dictionary.to_pylist(),
+                   attributes.offsets.to_numpy(), values.indices.to_numpy(), postings.offsets.to_numpy(), postings.flatten().to_numpy())
+
+    def rowsOf(self, codes):
+        # sampleDictionary codes -> CSR rows, -1 for runs without attributes
+        return rowsOf(self.rowOf, codes)
+
+    def runBitmap(self, attributes):
+        bitmap = np.zeros(self.nRuns, dtype = bool)
+        ids = np.array([self.attributeCodes[a] for a in attributes if a in self.attributeCodes], dtype = np.int64)
+        positions, _ = expandRanges(self.postingPtr, ids)
+        bitmap[self.postingRuns[positions]] = True
+        return bitmap
+
+    def rowsWithAny(self, rowNumbers, codes, nRows, attributes):
+        # For each of `nRows` rows, whether any of its calls (row number, sample code) is from a sample
+        # carrying any of `attributes`.
+        codes = self.rowsOf(codes)
+        known = codes >= 0
+        hits = self.runBitmap(attributes)[codes[known]]
+        return np.bincount(rowNumbers[known][hits], minlength = nRows) > 0
+
+    def facetCounts(self, rowNumbers, codes, nRows):
+        # Number of distinct samples and of rows (variants) per attribute, in one pass over all calls.
+        codes = self.rowsOf(codes)
+        known = codes >= 0
+        rowNumbers, codes = rowNumbers[known], codes[known]
+        positions, counts = expandRanges(self.indptr, codes)
+        attributeIds = self.indices[positions].astype(np.int64)
+        nRuns, nRows, nAttributes = self.nRuns, nRows + 1, len(self.attributeNames)
+        samplePairs = np.unique(attributeIds * nRuns + np.repeat(codes, counts))
+        variantPairs = np.unique(attributeIds * nRows + np.repeat(rowNumbers, counts))
+        samples = np.bincount(samplePairs // nRuns, minlength = nAttributes)
+        variants = np.bincount(variantPairs // nRows, minlength = nAttributes)
+        present = np.flatnonzero(variants)
+        return pd.DataFrame({'Attribute' : self.attributeNames[present], 'Samples' : samples[present], 'Variants' : variants[present]})
+
+
+class StudyIndex:
+    # The SRA study/sample table as arrays: one row per (run, study), the rows of a run addressed by
+    # its sampleDictionary code (CSR), with the study as a category code into the `studies`
+    # dictionary. Run accessions are not kept, they decode from the codes, and BioSamples and study
+    # titles stay in their Arrow arrays until rows are asked for.
+
+    def __init__(self, rowPtr, rows, bioSamples, studyCodes, studies):
+        self.rowPtr = rowPtr
+        self.rows = rows
+        self.bioSamples = bioSamples
+        self.studyCodes = studyCodes
+        self.studies = studies
+
+    @classmethod
+    def fromTables(cls, tables):
+        # samples.StudyRows and studies.BioSample, studies.Study Title (dictionary-encoded), as made
+        # by referencedata
+        studies = column(tables['studies'], 'Study Title')
+        rows = column(tables['samples'], 'StudyRows')
+        return cls(rows.offsets.to_numpy(), rows.flatten().to_numpy(), column(tables['studies'], 'BioSample'),
+                   studies.indices.to_numpy(), studies.dictionary)
+
+    def __len__(self):
+        return len(self.studyCodes)
+
+    def rowsOf(self, codes):
+        # sampleDictionary codes -> (position in `codes`, table row) of every study row of each run;
+        # runs not in any study have none
+        codes = np.asarray(codes, dtype = np.int64)
+        known = np.flatnonzero((codes >= 0) & (codes < len(self.rowPtr) - 1))
+        positions, counts = expandRanges(self.rowPtr, codes[known])
+        return np.repeat(known, counts), self.rows[positions].astype(np.int64)
+
+    def bioSamplesOf(self, rows):
+        return self.bioSamples.take(pa.array(rows, type = pa.int64())).to_numpy(zero_copy_only = False)
+
+    def titles(self, studyCodes):
+        return self.studies.take(pa.array(studyCodes, type = pa.int64())).to_pylist()
+
+    def studyCounts(self, rows):
+        # Number of `rows` per study code
+        return np.bincount(self.studyCodes[rows], minlength = len(self.studies))
+
+    def rank(self, rows):
+        # -> (codes of the studies of `rows` by decreasing count, position of each row's study in
+        # that ranking)
+        counts = self.studyCounts(rows)
+        present = np.flatnonzero(counts)
+        ranked = present[np.argsort(-counts[present], kind = 'stable')]
+        position = np.full(len(self.studies), -1, dtype = np.int64)
+        position[ranked] = np.arange(len(ranked))
+        return ranked, position[self.studyCodes[rows]]
+
+
+def symbolSlots(keys):
+    # Open-addressing hash table over the upper-cased symbols `keys`: slot -> 1 + position of its
+    # key, 0 when empty. Slots are found by crc32 of the key and linear probing, with at least twice
+    # as many slots as keys.
+    slots = np.zeros(1 << max(1, int(2 * len(keys)).bit_length()), dtype = np.int32)
+    mask = len(slots) - 1
+    for n, key in enumerate(keys):
+        slot = zlib.crc32(key) & mask
+        while slots[slot] != 0:
+            if keys[slots[slot] - 1] == key:
+                break
+            slot = (slot + 1) & mask
+        else:
+            slots[slot] = n + 1
+    return slots
+
+
+class GeneIndex:
+    # Gene symbol -> coordinates per reference. Exact symbols are found through a hash table of the
+    # upper-cased symbols (symbolSlots) and prefixes by binary search over the same keys, which the
+    # genes table of referencedata keeps sorted.
+
+    references = ('hg38', 'hg19', 'chm13v2')
+
+    def __init__(self, table, slots):
+        self.keys = fixedWidth(column(table, 'Key'))
+        self.slots = slots
+        self.symbols = column(table, 'Gene')
+        self.coordinates = {reference : column(table, reference) for reference in self.references}
+
+    @classmethod
+    def fromTables(cls, tables):
+        return cls(tables['genes'], column(tables['gene_slots'], 'Slot').to_numpy())
+
+    def position(self, key):
+        # Row of the upper-cased symbol `key` (bytes), None if it is not a gene
+        mask = len(self.slots) - 1
+        slot = zlib.crc32(key) & mask
+        while self.slots[slot] != 0:
+            if self.keys[self.slots[slot] - 1] == key:
+                return self.slots[slot] - 1
+            slot = (slot + 1) & mask
+        return None
+
+
+    def lookup(self, symbol, reference):
+        n = self.position(symbol.strip().upper().encode('utf-8'))
+        if n == None:
+            return None
+        return self.coordinates[reference][n].as_py()
+
+    def entry(self, n):
+        entry = {'gene' : self.symbols[n].as_py()}
+        for reference in self.references:
+            entry[reference] = self.coordinates[reference][n].as_py()
+        return entry
+
+    def complete(self, prefix, limit = 10):
+        prefix = prefix.strip().upper().encode('utf-8')
+        if len(prefix) == 0:
+            return []
+        matches = []
+        if len(prefix) > self.keys.itemsize:
+            return []
+        n = np.searchsorted(self.keys, np.array(prefix, dtype = self.keys.dtype))
+        while n < len(self.keys) and len(matches) < limit and self.keys[n].startswith(prefix):
+            matches.append(self.entry(n))
+            n += 1
+        return matches
+
+
+def normalizeChromosome(chromosome):
+    return str(chromosome).upper().replace('CHR', '').replace('MT', 'M')
+
+
+class GeneIntervalIndex:
+    # Per (reference, chromosome): genes sorted by start with a running maximum of their ends,
+    # so overlaps with a position or range are found with two binary searches. The arrays are slices
+    # of the gene_intervals table of referencedata, grouped by 'reference\tchromosome'.
+
+    def __init__(self, table):
+        self.intervals = {}
+        groups = column(table, 'Group')
+        if len(groups) == 0:
+            return
+        codes = groups.indices.to_numpy()
+        bounds = np.searchsorted(codes, np.arange(len(groups.dictionary) + 1))
+        starts, ends, maxEnds, genes = [column(table, name) for name in ('Start', 'End', 'MaxEnd', 'Gene')]
+        starts, ends, maxEnds = starts.to_numpy(), ends.to_numpy(), maxEnds.to_numpy()
+        for group, first, last in zip(groups.dictionary.to_pylist(), bounds[:-1], bounds[1:]):
+            reference, chromosome = group.split('\t')
+            self.intervals[(reference, chromosome)] = (starts[first:last], ends[first:last], maxEnds[first:last], genes.slice(first, last - first))
+
+    @classmethod
+    def fromTables(cls, tables):
+        return cls(tables['gene_intervals'])
+
+    def _candidates(self, reference, chromosome, starts, ends):
+        intervals = self.intervals.get((reference, normalizeChromosome(chromosome)))
+        if intervals == None:
+            return None, np.zeros(len(starts), dtype = np.int64), np.zeros(len(starts), dtype = np.int64)
+        geneStarts, _, maxEnds, _ = intervals
+        return intervals, np.searchsorted(maxEnds, starts, 'left'), np.searchsorted(geneStarts, ends, 'right')
+
+    def overlapping(self, reference, chromosome, start, end = None):
+        if end == None:
+            end = start
+        intervals, lo, hi = self._candidates(reference, chromosome, [start], [end])
+        if intervals == None or hi[0] <= lo[0]:
+            return []
+        _, geneEnds, _, genes = intervals
+        genes = genes.slice(lo[0], hi[0] - lo[0]).to_numpy(zero_copy_only = False)
+        return list(dict.fromkeys(genes[geneEnds[lo[0]:hi[0]] >= start]))
+
+    def annotate(self, reference, coordinates):
+        # 'chr:pos' strings -> comma separated names of the genes overlapping each position
+        coordinates = pd.Series(coordinates, dtype = object).reset_index(drop = True)
+        if coordinates.empty:
+            return np.array([], dtype = object)
+        parts = coordinates.str.partition(':')
+        chromosomes = parts[0].str.upper().str.replace('CHR', '').str.replace('MT', 'M')
+        positions = pd.to_numeric(parts[2].str.split('-').str[0], errors = 'coerce')
+        labels = np.full(len(parts), '', dtype = object)
+        known = positions.notna()
+        for chromosome, rows in chromosomes[known].groupby(chromosomes[known], sort = False).indices.items():
+            rows = np.flatnonzero(known)[rows]
+            points = positions.iloc[rows].to_numpy(dtype = np.int64)
+            intervals, lo, hi = self._candidates(reference, chromosome, points, points)
+            if intervals == None or (hi > lo).any() == False:
+                continue
+            _, geneEnds, _, genes = intervals
+            # only the genes some position can overlap are converted to Python strings
+            first, last = lo[hi > lo].min(), hi.max()
+            genes = genes.slice(first, last - first).to_numpy(zero_copy_only = False)
+            for row, point, start, end in zip(rows, points, lo, hi):
+                if end <= start:
+                    continue
+                candidates = slice(start, end)
+                labels[row] = ', '.join(dict.fromkeys(genes[start - first:end - first][geneEnds[candidates] >= point]))
+        return labels
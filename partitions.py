@@ -0,0 +1,280 @@
+# Partition layout of the GeniePool dataset on S3 and the planning of which parquet objects a region needs.
+
+import asyncio
+import functools
+import io
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import fsspec
+import fsspec.asyn
+from fsspec.implementations.local import LocalFileSystem
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from diskcache import DiskCache
+
+S3_ROOT = 's3://genetics-repo'
+BUCKET_SIZE = 100000
+# A local directory or mounted volume holding a copy of the S3 layout. When set, searches are
+# served from it alone, without the REST API.
+MIRROR_ROOT = os.environ.get('GENIEPOOL_MIRROR')
+MAX_CONCURRENCY = int(os.environ.get('GENIEPOOL_S3_CONCURRENCY', 8))
+COLUMNS = ('pos', 'entries')
+FOOTER_PREFETCH = 64 * 1024
+RANGE_GAP = 64 * 1024
+
+
+def partitionUri(root, version, reference, chromosome, modulus, part):
+    return root + '/' + version + '/' + reference + '/chrom=chr' + str(chromosome) + '/pos_bucket=' + str(modulus) + '/part-' + part + '.snappy.parquet'
+
+
+def partitionTable(s3map):
+    # S3.map rows -> Arrow table sorted by (reference and chromosome, modulus), with that order as an
+    # int64 Key (group code << 32 | modulus) so that a bucket is found by binary search.
+    df = s3map[['version', 'reference', 'chromosome', 'modulus', 'id']].astype({'version' : str, 'reference' : str, 'chromosome' : str, 'modulus' : 'int64', 'id' : str})
+    df = df.assign(group = df['reference'] + '\t' + df['chromosome']).sort_values(['group', 'modulus'], kind = 'stable')
+    groups = pd.Categorical(df['group'])
+    codes = groups.codes.astype(np.int32)
+    table = pa.Table.from_pandas(df.drop(columns = ['group']), preserve_index = False)
+    table = table.append_column('Key', pa.array((codes.astype(np.int64) << 32) | df['modulus'].to_numpy()))
+    return table.append_column('Group', pa.DictionaryArray.from_arrays(pa.array(codes), pa.array(groups.categories.tolist(), type = pa.string())))
+
+
+class PartitionMap:
+    # (reference, chromosome, modulus) -> part URIs, found by binary search over the Key column of a
+    # partitionTable, which may be memory-mapped.
+
+    def __init__(self, table, root = S3_ROOT):
+        self.root = root
+        self.table = table.combine_chunks()
+        self.keys = self.table.column('Key').chunk(0).to_numpy() if self.table.num_rows > 0 else np.zeros(0, dtype = np.int64)
+        groups = self.table.column('Group').chunk(0).dictionary if self.table.num_rows > 0 else pa.array([], type = pa.string())
+        self.groups = {group : n for n, group in enumerate(groups.to_pylist())}
+
+    @classmethod
+    def fromTables(cls, tables, root = S3_ROOT):
+        return cls(tables['partitions'], root)
+
+    @classmethod
+    def fromLayout(cls, root):
+        # Discover the partitions of a mirror from its directory layout instead of S3.map.
+        fs, path = fsspec.core.url_to_fs(root)
+        rows = []
+        for uri in fs.glob(path.rstrip('/') + '/*/*/chrom=chr*/pos_bucket=*/part-*.snappy.parquet'):
+            version, reference, chromosome, modulus, part = uri[len(path.rstrip('/')) + 1:].split('/')
+            rows.append([version, reference, chromosome[len('chrom=chr'):], int(modulus[len('pos_bucket='):]), part[len('part-'):-len('.snappy.parquet')]])
+        return cls(partitionTable(pd.DataFrame(rows, columns = ['version', 'reference', 'chromosome', 'modulus', 'id'])), root.rstrip('/'))
+
+    def lookup(self, reference, chromosome, modulus):
+        group = self.groups.get(reference + '\t' + str(chromosome))
+        if group == None:
+            return []
+        key = (group << 32) | int(modulus)
+        first, last = np.searchsorted(self.keys, [key, key + 1])
+        rows = self.table.slice(first, last - first)
+        return [partitionUri(self.root, *row) for row in zip(*[rows.column(name).to_pylist() for name in ('version', 'reference', 'chromosome', 'modulus', 'id')])]
+
+    def plan(self, reference, chromosome, start, end):
+        uris = []
+        for modulus in range(start // BUCKET_SIZE, end // BUCKET_SIZE + 1):
+            uris += self.lookup(reference, chromosome, modulus)
+        return uris
+
+
+# Concurrent reads of the planned partitions. The coroutines run on fsspec's IO loop, so s3fs
+# (aiobotocore) keeps one connection pool per worker; synchronous filesystems (local, memory)
+# are read in the default thread pool instead. Only the row groups whose 'pos' statistics
+# overlap the region are downloaded, and only the byte ranges of the columns we decode.
+# Downloaded ranges are kept in a host-wide disk cache keyed by URI, object version and range.
+
+class FooterCache:
+    # (uri, object version) -> (object size, object version, parquet FileMetaData), least recently
+    # used entries dropped first. Keyed by version, so a rewritten object never gets the footer of
+    # the one it replaced.
+
+    def __init__(self, maxEntries = 4096):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            footer = self.entries.get(key)
+            if footer != None:
+                self.entries.move_to_end(key)
+            return footer
+
+    def put(self, key, footer):
+        with self.lock:
+            self.entries[key] = footer
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)
+
+footerCache = FooterCache()
+partitionCache = DiskCache()
+
+
+class SparseFile(io.RawIOBase):
+    # Read-only file of a known size of which only some byte ranges were downloaded.
+
+    def __init__(self, size, ranges, chunks):
+        self.size = size
+        self.ranges = list(zip(ranges, chunks))
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, n = -1):
+        if n < 0:
+            n = self.size - self.position
+        for (start, end), chunk in self.ranges:
+            if start <= self.position < end:
+                data = chunk[self.position - start : min(self.position + n, end) - start]
+                self.position += len(data)
+                return data
+        raise IOError('Byte range ' + str(self.position) + '-' + str(self.position + n) + ' was not fetched')
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+async def inExecutor(function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+async def catRange(fs, uri, start, end):
+    if fs.async_impl:
+        return await fs._cat_file(uri, start = start, end = end)
+    return await inExecutor(fs.cat_file, uri, start = start, end = end)
+
+async def objectInfo(fs, uri):
+    if fs.async_impl:
+        info = await fs._info(uri)
+    else:
+        info = await inExecutor(fs.info, uri)
+    version = info.get('ETag') or info.get('VersionId') or info.get('mtime') or info.get('created') or ''
+    return info['size'], str(version)
+
+async def cachedRange(fs, uri, version, start, end):
+    if isinstance(fs, LocalFileSystem):
+        return await catRange(fs, uri, start, end)
+    key = (uri, version, start, end)
+    data = await inExecutor(partitionCache.get, key)
+    if data == None:
+        data = await catRange(fs, uri, start, end)
+        await inExecutor(partitionCache.put, key, data)
+    return data
+
+async def readFooter(fs, uri):
+    # The object's current version is looked up on every read; only its own footer is reused.
+    size, version = await objectInfo(fs, uri)
+    footer = footerCache.get((uri, version))
+    if footer != None:
+        return footer
+    tail = await cachedRange(fs, uri, version, max(0, size - FOOTER_PREFETCH), size)
+    footerLength = int.from_bytes(tail[-8:-4], 'little')
+    if footerLength + 8 > len(tail):
+        tail = await cachedRange(fs, uri, version, size - footerLength - 8, size)
+    metadata = pq.read_metadata(pa.BufferReader(b'PAR1' + tail[-(footerLength + 8):]))
+    footer = (size, version, metadata)
+    footerCache.put((uri, version), footer)
+    return footer
+
+def selectRowGroups(metadata, start, end):
+    schema = metadata.schema
+    pos = [schema.column(j).path for j in range(metadata.num_columns)].index('pos')
+    rowGroups = []
+    for i in range(metadata.num_row_groups):
+        rowGroup = metadata.row_group(i)
+        statistics = rowGroup.column(pos).statistics
+        if statistics is None or statistics.has_min_max == False or (statistics.min <= end and statistics.max >= start):
+            rowGroups.append(i)
+    return rowGroups
+
+def columnRanges(metadata, rowGroups, columns):
+    # One byte range per row group (its column chunks are contiguous), so that cached ranges
+    # are reused by any later region touching the same row group.
+    ranges = []
+    for i in rowGroups:
+        rowGroup = metadata.row_group(i)
+        chunks = []
+        for j in range(rowGroup.num_columns):
+            column = rowGroup.column(j)
+            if column.path_in_schema.split('.')[0] not in columns:
+                continue
+            start = column.data_page_offset
+            if column.has_dictionary_page and column.dictionary_page_offset:
+                start = min(start, column.dictionary_page_offset)
+            chunks.append((start, start + column.total_compressed_size))
+        for start, end in sorted(chunks):
+            if len(ranges) > 0 and ranges[-1][2] == i and start - ranges[-1][1] <= RANGE_GAP:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end), i)
+            else:
+                ranges.append((start, end, i))
+    return [(start, end) for start, end, _ in ranges]
+
+def decodeRowGroups(source, metadata, rowGroups, columns, start, end):
+    table = pq.ParquetFile(source, metadata = metadata, pre_buffer = False).read_row_groups(rowGroups, columns = list(columns))
+    df = table.to_pandas()
+    return df[df['pos'].between(start, end)]
+
+async def readPartition(fs, uri, start, end, semaphore, columns = COLUMNS):
+    async with semaphore:
+        size, version, metadata = await readFooter(fs, uri)
+        rowGroups = selectRowGroups(metadata, start, end)
+        if len(rowGroups) == 0:
+            return pd.DataFrame()
+        ranges = columnRanges(metadata, rowGroups, columns)
+        chunks = await asyncio.gather(*[cachedRange(fs, uri, version, a, b) for a, b in ranges])
+    return await inExecutor(decodeRowGroups, SparseFile(size, ranges, chunks), metadata, rowGroups, columns, start, end)
+
+async def fetchPartitionsAsync(fs, uris, start, end, maxConcurrency = MAX_CONCURRENCY):
+    semaphore = asyncio.Semaphore(maxConcurrency)
+    tasks = [asyncio.ensure_future(readPartition(fs, uri, start, end, semaphore)) for uri in uris]
+    results = []
+    try:
+        for task in asyncio.as_completed(tasks):
+            df = await task
+            if df.empty == False:
+                results.append(df)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return results
+
+def submitPartitions(uris, start, end, maxConcurrency = MAX_CONCURRENCY):
+    # concurrent.futures.Future of the partition frames; cancelling it cancels the in-flight reads.
+    if len(uris) == 0:
+        future = Future()
+        future.set_result([])
+        return future
+    fs, _ = fsspec.core.url_to_fs(uris[0])
+    return asyncio.run_coroutine_threadsafe(fetchPartitionsAsync(fs, uris, start, end, maxConcurrency), fsspec.asyn.get_loop())
+
+def mergePartitions(results):
+    if len(results) == 0:
+        return pd.DataFrame()
+    return pd.concat(results).sort_values('pos', kind = 'stable').reset_index(drop = True)
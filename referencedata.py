@@ -0,0 +1,221 @@
+# Reference tables of assets/ as memory-mapped Arrow IPC files.
+# `python referencedata.py [assets]` converts the source tables (TSV, S3.map, parquet) into
+# uncompressed Arrow IPC (Feather v2) files next to them, together with everything the indexes
+# derive from them: the sorted run accessions whose positions are the run codes, the run -> row
+# arrays, the attribute postings and the sorted gene and partition keys. Workers map those
+# read-only, so their buffers live in the page cache shared by every process of the host and
+# building an index neither parses nor copies anything; a group of tables whose .arrow files are
+# missing or older than its sources is built from the sources instead.
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from indexes import GeneIndex, normalizeChromosome, symbolSlots
+from partitions import partitionTable
+
+ASSETS = 'assets'
+
+
+def fixedWidthArray(values):
+    # Sorted 'S<width>' numpy array -> fixed_size_binary Arrow array on the same bytes
+    width = max(values.itemsize, 1)
+    values = values.astype('S' + str(width))
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(width), len(values), [None, pa.py_buffer(values.tobytes())])
+
+def encodeStrings(values):
+    return np.char.encode(np.asarray(values, dtype = str), 'utf-8')
+
+def lastRows(runs, rowRuns):
+    # Row of each of the sorted `runs` in a table whose rows are the runs `rowRuns`: the last such
+    # row, -1 for runs without one
+    rowOf = np.full(len(runs), -1, dtype = np.int64)
+    rowOf[np.searchsorted(runs, rowRuns)] = np.arange(len(rowRuns))
+    return rowOf
+
+def allRows(runs, rowRuns):
+    # Rows of each of the sorted `runs` in a table whose rows are the runs `rowRuns`, as a list
+    # array (CSR: the offsets are indexed by run code)
+    codes = np.searchsorted(runs, rowRuns)
+    order = np.argsort(codes, kind = 'stable').astype(np.int32)
+    offsets = np.searchsorted(codes[order], np.arange(len(runs) + 1)).astype(np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets), pa.array(order))
+
+def buildSamples(studiesPath, attributesPath):
+    # SRA_studies_and_samples.tsv and attributes.parquet ->
+    #   samples: every run, sorted (a run's position is its sampleDictionary code), with its rows in
+    #            studies (StudyRows, all of them: a run may belong to several studies) and its row in
+    #            attributes (AttributeRow)
+    #   studies: BioSample and dictionary-encoded Study Title per row of the TSV
+    #   attributes: lists of dictionary-encoded attribute names per row of the parquet (CSR)
+    #   attribute_postings: rows of attributes per attribute name (inverted CSR)
+    studies = pd.read_csv(studiesPath, sep = '\t', usecols = ['Run', 'BioSample', 'Study Title'], dtype = str)
+    attributes = pq.read_table(attributesPath, columns = ['Run', 'Attributes']).combine_chunks()
+    studyRuns = encodeStrings(studies['Run'])
+    attributeRuns = encodeStrings(attributes.column('Run').to_pylist())
+    runs = np.unique(np.concatenate([studyRuns, attributeRuns]))
+    samples = pa.table({
+        'Run' : fixedWidthArray(runs),
+        'StudyRows' : allRows(runs, studyRuns.astype(runs.dtype)),
+        'AttributeRow' : lastRows(runs, attributeRuns.astype(runs.dtype)),
+    })
+    studyTable = pa.table({
+        'BioSample' : pa.array(studies['BioSample'], type = pa.string()),
+        'Study Title' : pc.dictionary_encode(pa.array(studies['Study Title'], type = pa.string())),
+    })
+    lists = attributes.column('Attributes').chunk(0) if attributes.num_rows > 0 else pa.array([], type = pa.list_(pa.string()))
+    offsets = np.asarray(lists.offsets, dtype = np.int32)
+    values = pc.dictionary_encode(lists.flatten())
+    indices = values.indices.to_numpy()
+    order = np.argsort(indices, kind = 'stable')
+    postingRows = np.repeat(np.arange(len(offsets) - 1, dtype = np.int32), np.diff(offsets))[order]
+    postingPtr = np.zeros(len(values.dictionary) + 1, dtype = np.int32)
+    np.cumsum(np.bincount(indices, minlength = len(values.dictionary)), out = postingPtr[1:])
+    return {
+        'samples' : samples,
+        'studies' : studyTable,
+        'attributes' : pa.table({'Attributes' : pa.ListArray.from_arrays(pa.array(offsets - offsets[0]), values)}),
+        'attribute_postings' : pa.table({'Attribute' : values.dictionary, 'Rows' : pa.ListArray.from_arrays(pa.array(postingPtr), pa.array(postingRows))}),
+    }
+
+def buildGenes(path):
+    # genes_to_coordinates.parquet ->
+    #   genes: one row per symbol, sorted by the upper-cased symbol (Key)
+    #   gene_slots: hash table of those keys (indexes.symbolSlots)
+    #   gene_intervals: genes by 'reference\tchromosome' (Group) and start, with the running maximum
+    #                   of their ends per group (MaxEnd)
+    genes = pq.read_table(path).to_pandas().drop_duplicates('Gene').reset_index(drop = True)
+    keys = encodeStrings(genes['Gene'].str.upper())
+    order = np.argsort(keys, kind = 'stable')
+    genes, keys = genes.iloc[order].reset_index(drop = True), keys[order]
+    columns = {'Key' : fixedWidthArray(keys), 'Gene' : pa.array(genes['Gene'], type = pa.string())}
+    for reference in GeneIndex.references:
+        columns[reference] = pa.array(genes[reference], type = pa.string())
+    intervals = []
+    for reference in GeneIndex.references:
+        parts = genes[reference].str.extract(r'^(\w+):(\d+)-(\d+)$')
+        intervals.append(pd.DataFrame({
+            'group' : reference + '\t' + parts[0].map(normalizeChromosome),
+            'start' : pd.to_numeric(parts[1]),
+            'end' : pd.to_numeric(parts[2]),
+            'gene' : genes['Gene'],
+        }).dropna())
+    intervals = pd.concat(intervals).sort_values(['group', 'start'], kind = 'stable').reset_index(drop = True)
+    groups = pd.Categorical(intervals['group'])
+    ends = intervals['end'].astype(np.int64)
+    return {
+        'genes' : pa.table(columns),
+        'gene_slots' : pa.table({'Slot' : symbolSlots(keys)}),
+        'gene_intervals' : pa.table({
+            'Group' : pa.DictionaryArray.from_arrays(pa.array(groups.codes.astype(np.int32)), pa.array(groups.categories.tolist(), type = pa.string())),
+            'Start' : pa.array(intervals['start'].astype(np.int64)),
+            'End' : pa.array(ends),
+            'MaxEnd' : pa.array(ends.groupby(intervals['group']).cummax().to_numpy(dtype = np.int64)),
+            'Gene' : pa.array(intervals['gene'], type = pa.string()),
+        }),
+    }
+
+def readS3Map(path):
+    return pd.read_csv(path, sep = '\t', header = None, names = ['version', 'reference', 'chromosome', 'modulus', 'id'], dtype = {'version' : str, 'chromosome' : str, 'id' : str})
+
+def buildPartitions(path):
+    return {'partitions' : partitionTable(readS3Map(path))}
+
+# group -> (source files, builder of the group's tables from them, names of those tables)
+GROUPS = {
+    'samples' : (('SRA_studies_and_samples.tsv', 'attributes.parquet'), buildSamples, ('samples', 'studies', 'attributes', 'attribute_postings')),
+    'genes' : (('genes_to_coordinates.parquet',), buildGenes, ('genes', 'gene_slots', 'gene_intervals')),
+    'partitions' : (('S3.map',), buildPartitions, ('partitions',)),
+}
+
+
+def arrowPath(name, assets = ASSETS):
+    return os.path.join(assets, name + '.arrow')
+
+def build(assets = ASSETS, groups = None):
+    # Builds the groups whose sources are all present in `assets` -> {table: bytes written}
+    written = {}
+    for group in groups or GROUPS:
+        sources, builder, _ = GROUPS[group]
+        if all(os.path.exists(os.path.join(assets, source)) for source in sources) == False:
+            continue
+        for name, table in builder(*[os.path.join(assets, source) for source in sources]).items():
+            table = table.combine_chunks()
+            path = arrowPath(name, assets)
+            with pa.OSFile(path + '.tmp', 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(path + '.tmp', path)
+            written[name] = os.path.getsize(path)
+    return written
+
+
+class ReferenceTables:
+    # Loads the reference tables of a worker and the indexes built on them, and records how each was
+    # loaded and how long it took.
+
+    def __init__(self, assets = ASSETS):
+        self.assets = assets
+        self.started = time.time()
+        self.startup = None
+        self.loads = {}
+        self.groups = {}
+
+    def tables(self, group):
+        # -> ({table: Arrow table} of the group, 'arrow' if they were mapped or 'source' if built)
+        if group not in self.groups:
+            sources, builder, names = GROUPS[group]
+            sources = [os.path.join(self.assets, source) for source in sources]
+            paths = [arrowPath(name, self.assets) for name in names]
+            newest = max([os.path.getmtime(source) for source in sources if os.path.exists(source)], default = 0)
+            if all(os.path.exists(path) and os.path.getmtime(path) >= newest for path in paths):
+                tables = {name : pa.ipc.open_file(pa.memory_map(path, 'r')).read_all() for name, path in zip(names, paths)}
+                self.groups[group] = (tables, 'arrow')
+            else:
+                self.groups[group] = (builder(*sources), 'source')
+        return self.groups[group]
+
+    def load(self, name, constructor, group):
+        # constructor(tables of `group`) -> index; the recorded time covers opening or building the
+        # tables (the first time the group is used) and building the index.
+        start = time.perf_counter()
+        tables, origin = self.tables(group)
+        index = constructor(tables)
+        self.loads[name] = {'origin' : origin, 'rows' : max(table.num_rows for table in tables.values()), 'seconds' : round(time.perf_counter() - start, 4)}
+        return index
+
+    def ready(self):
+        # Marks the end of the worker's startup.
+        self.startup = round(time.time() - self.started, 4)
+
+    def stats(self):
+        return {'startup_seconds' : self.startup, 'tables' : self.loads, 'memory' : memoryStats()}
+
+
+def memoryStats():
+    # Resident memory of this process in bytes. RssFile is the part backed by mapped files, which the
+    # workers of a host share; RssAnon is private to the worker.
+    stats = {}
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM', 'RssAnon', 'RssFile', 'RssShmem'):
+                    stats[key] = int(value.split()[0]) * 1024
+    except OSError:
+        import resource
+        stats['VmHWM'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    stats['pid'] = os.getpid()
+    return stats
+
+
+if __name__ == '__main__':
+    assets = sys.argv[1] if len(sys.argv) > 1 else ASSETS
+    for name, size in build(assets).items():
+        print(arrowPath(name, assets), '{:,}'.format(size), 'bytes')
@@ -0,0 +1,266 @@
+# Columnar form of a search result.
+# The nested pos/entries rows are flattened once into one row per variant and one array entry per
+# sample call (variant index, sample code, qual, ref/alt depth, zygosity), so that the quality and
+# coverage filters are array masks and the zygosity counts a bincount. Results are kept in a
+# ResultStore with the thresholds they were fetched at, so that raising them only re-filters.
+
+import os
+import pickle
+import re
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from diskcache import DiskCache, privateDirectory
+from indexes import sampleDictionary
+
+RESULT_STORE_ENTRIES = int(os.environ.get('GENIEPOOL_RESULT_STORE_ENTRIES', 32))
+RESULT_STORE_DIR = os.environ.get('GENIEPOOL_RESULT_STORE_DIR', os.path.join(tempfile.gettempdir(), 'geniepool-results'))
+RESULT_STORE_BYTES = int(os.environ.get('GENIEPOOL_RESULT_STORE_BYTES', 512 * 1024 ** 2))
+RESULT_TTL = float(os.environ.get('GENIEPOOL_RESULT_TTL', 3600))
+PAGE_SIZE = 25
+# One '{column} operator value' term of a DataTable filter_query; the operator may carry the i/s
+# (case-insensitive/sensitive) prefix.
+FILTER_TERM = re.compile(r'\{(?P<column>[^}]+)\}\s+(?P<case>[is]?)(?P<operator>>=|<=|!=|<|>|=|eq|ne|lt|le|gt|ge|contains|datestartswith)\s+(?P<value>.*)$')
+OPERATORS = {'eq' : '=', 'ne' : '!=', 'lt' : '<', 'le' : '<=', 'gt' : '>', 'ge' : '>='}
+VARIANT_COLUMNS = ['Coordinate', 'Variant', 'Impact', 'dbSNP', 'AlphaMissense', 'gnomad_an', 'gnomad_ac', 'gnomad_nhomalt', 'hg38_coordinate']
+
+
+def variantFields(chromosome, position, mutation):
+    dbSNP = mutation.get('dbSNP', '')
+    return [chromosome + ':' + str(position),
+            mutation['ref'] + '>' + mutation['alt'],
+            mutation.get('impact', ''),
+            dbSNP if str(dbSNP).startswith('rs') else '',
+            mutation.get('alphamissense', ''),
+            mutation.get('gnomad_an', 0),
+            mutation.get('gnomad_ac', 0),
+            mutation.get('gnomad_nhomalt', 0),
+            mutation.get('hg38_coordinate', '')]
+
+def parseDepths(ads):
+    # 'ref,alt[,...]' strings -> (depth of the first alt allele, total depth), parsed in one pass
+    if len(ads) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    values = np.array(','.join(ads).split(','), dtype = np.int64)
+    fields = np.fromiter((ad.count(',') + 1 for ad in ads), dtype = np.int64, count = len(ads))
+    offsets = np.concatenate(([0], np.cumsum(fields)[:-1]))
+    alt = np.where(fields > 1, values[np.minimum(offsets + 1, len(values) - 1)], 0)
+    return alt, np.add.reduceat(values, offsets)
+
+
+class VariantResult:
+
+    def __init__(self, variants, records, variantIndex, hom):
+        # variants: one row per variant (VARIANT_COLUMNS); records: the calls' original dicts, grouped
+        # by variant with each variant's homozygous calls before its heterozygous ones. Within those
+        # groups calls are kept in decreasing quality, so the calls of a group passing a quality
+        # threshold are a prefix of it.
+        # Qualities are integers, as the API sends them, unless some are not (partitions may hold
+        # them as floats).
+        qual = np.array([call['qual'] for call in records], dtype = np.float64)
+        if np.array_equal(qual, np.floor(qual)):
+            qual = qual.astype(np.int64)
+        order = np.lexsort((-qual, ~hom, variantIndex))
+        self.variants = variants
+        self.records = records[order]
+        self.variantIndex = variantIndex[order]
+        self.hom = hom[order]
+        self.qual = qual[order]
+        # group of each call (2 * variant, + 1 for heterozygous calls) and a key ordered like the
+        # calls: group, then quality level descending
+        self.group = self.variantIndex * 2 + ~self.hom
+        self.groups = np.unique(self.group)
+        self.qualLevels = np.unique(self.qual)
+        self.qualKey = self.group * len(self.qualLevels) + (len(self.qualLevels) - 1 - np.searchsorted(self.qualLevels, self.qual))
+        self.codes = sampleDictionary.intern([call['id'] for call in self.records])
+        self.adAlt, self.coverage = parseDepths([call['ad'] for call in self.records])
+
+    @classmethod
+    def fromMutations(cls, chromosomes, positions, mutations):
+        rows, records, variantIndex, hom = [], [], [], []
+        for chromosome, position, mutation in zip(chromosomes, positions, mutations):
+            n = len(rows)
+            rows.append(variantFields(chromosome, position, mutation))
+            homs, hets = list(mutation['hom']), list(mutation['het'])
+            records += homs + hets
+            variantIndex += [n] * (len(homs) + len(hets))
+            hom += [True] * len(homs) + [False] * len(hets)
+        calls = np.empty(len(records), dtype = object)
+        calls[:] = records
+        return cls(pd.DataFrame(rows, columns = VARIANT_COLUMNS), calls,
+                   np.array(variantIndex, dtype = np.int64), np.array(hom, dtype = bool))
+
+    @classmethod
+    def fromRows(cls, chromosome, df):
+        # pos/entries frame of a region search -> result
+        positions, mutations = [], []
+        for position, entries in zip(df['pos'].tolist(), df['entries'].tolist()):
+            for mutation in entries:
+                positions.append(position)
+                mutations.append(mutation)
+        return cls.fromMutations([chromosome] * len(positions), positions, mutations)
+
+    def __len__(self):
+        return len(self.variants)
+
+    def __getstate__(self):
+        # Sample codes are only meaningful within one process; they are interned again on load.
+        state = dict(self.__dict__)
+        del state['codes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.codes = sampleDictionary.intern([call['id'] for call in self.records])
+
+    def qualified(self, minQual = 0):
+        # Calls with qual >= minQual: one binary search per (variant, zygosity) group for the end of
+        # the group's passing prefix
+        levels = len(self.qualLevels)
+        lowest = levels - 1 - np.searchsorted(self.qualLevels, minQual or 0)
+        ends = np.searchsorted(self.qualKey, self.groups * levels + lowest, 'right')
+        passing = np.zeros(len(self.qual) + 1, dtype = np.int64)
+        np.add.at(passing, np.searchsorted(self.qualKey, self.groups * levels), 1)
+        np.add.at(passing, ends, -1)
+        return np.cumsum(passing[:-1]) > 0
+
+    def mask(self, minQual = 0, minCoverage = 0):
+        mask = self.qualified(minQual) if minQual not in (None, 0) else np.ones(len(self.qual), dtype = bool)
+        if minCoverage not in (None, 0):
+            mask &= self.coverage >= minCoverage
+        return mask
+
+    def counts(self, mask):
+        # -> (homozygotes, heterozygotes) per variant among the calls in `mask`
+        n = len(self.variants)
+        return (np.bincount(self.variantIndex[mask & self.hom], minlength = n),
+                np.bincount(self.variantIndex[mask & ~self.hom], minlength = n))
+
+    def samples(self, mask, counts):
+        # Calls selected by `mask`, split into one list per variant
+        return [i.tolist() for i in np.split(self.records[mask], np.cumsum(counts)[:-1])] if len(counts) > 0 else []
+
+    def calls(self, minQual = 0, minCoverage = 0):
+        # (row of table(minQual, minCoverage), sample code) of every call passing the filters
+        mask = self.mask(minQual, minCoverage)
+        kept = np.bincount(self.variantIndex[mask], minlength = len(self.variants)) > 0
+        return (np.cumsum(kept) - 1)[self.variantIndex[mask]], self.codes[mask]
+
+    def variantsOf(self, rows, minQual = 0, minCoverage = 0):
+        # Rows of table(minQual, minCoverage) -> their variant indices
+        homs, hets = self.counts(self.mask(minQual, minCoverage))
+        return np.flatnonzero((homs + hets) > 0)[np.asarray(rows, dtype = np.int64)]
+
+    def table(self, minQual = 0, minCoverage = 0):
+        # Variants with at least one call passing the filters, with those calls and their counts
+        mask = self.mask(minQual, minCoverage)
+        homs, hets = self.counts(mask)
+        df = self.variants.copy()
+        df['Homozygote Samples'] = self.samples(mask & self.hom, homs)
+        df['Heterozygote Samples'] = self.samples(mask & ~self.hom, hets)
+        df['Homozygotes'] = homs
+        df['Heterozygotes'] = hets
+        return df[(homs + hets) > 0].reset_index(drop = True)
+
+
+def filterFrame(df, query):
+    # Rows of `df` matching a DataTable filter_query ('{A} > 1 && {B} icontains x'), as column masks
+    if query in (None, ''):
+        return df
+    mask = np.ones(len(df), dtype = bool)
+    for term in query.split(' && '):
+        match = FILTER_TERM.match(term.strip())
+        if match == None or match['column'] not in df.columns:
+            continue
+        column, operator, value = df[match['column']], OPERATORS.get(match['operator'], match['operator']), match['value'].strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        if operator in ('contains', 'datestartswith'):
+            text = column.astype(str)
+            mask &= (text.str.contains(value, case = match['case'] == 's', regex = False) if operator == 'contains' else text.str.startswith(value)).to_numpy()
+            continue
+        if pd.api.types.is_numeric_dtype(column):
+            try:
+                value = float(value)
+            except ValueError:
+                mask &= False
+                continue
+        elif match['case'] != 's':
+            column, value = column.astype(str).str.lower(), value.lower()
+        mask &= {'=' : column == value, '!=' : column != value, '<' : column < value, '<=' : column <= value,
+                 '>' : column > value, '>=' : column >= value}[operator].to_numpy()
+    return df[mask]
+
+def sortFrame(df, sortBy):
+    if sortBy in (None, []):
+        return df
+    return df.sort_values([i['column_id'] for i in sortBy], ascending = [i['direction'] == 'asc' for i in sortBy], kind = 'stable')
+
+def page(df, current, size = PAGE_SIZE):
+    current = current or 0
+    return df.iloc[current * size : (current + 1) * size], max(1, -(-len(df) // size))
+
+
+class ResultStore:
+    # token -> unfiltered search (its VariantResult and what is needed to render it again).
+    # Searches are pickled into a DiskCache shared by the workers of the host, bounded in bytes and
+    # dropped after RESULT_TTL seconds without use, so a token resolves in whichever worker serves
+    # the callback; the most recently used ones are also kept unpickled in the worker.
+
+    def __init__(self, maxEntries = RESULT_STORE_ENTRIES, directory = RESULT_STORE_DIR, maxBytes = RESULT_STORE_BYTES, ttl = RESULT_TTL):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Entries are unpickled, so the directory must not be writable by other users.
+        self.disk = DiskCache(privateDirectory(directory) if maxBytes > 0 else directory, maxBytes, maxAge = ttl)
+
+    def remember(self, token, search):
+        with self.lock:
+            self.entries[token] = search
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)
+
+    def store(self, token, search):
+        # The formatted view and the carriers of the selected variant are derived from the calls and
+        # are not stored.
+        state = {k : v for k, v in dict(search).items() if k not in ('view', 'carriers')}
+        self.disk.put(('result', token), pickle.dumps(state, protocol = pickle.HIGHEST_PROTOCOL))
+
+    def put(self, search):
+        # maxBytes bounds the pickled searches on disk, for the whole host. The unpickled copies of
+        # a worker, with the views it builds from them, are not counted there: they are bounded by
+        # number only, maxEntries per worker.
+        token = uuid.uuid4().hex
+        self.store(token, search)
+        self.remember(token, search)
+        return token
+
+    def get(self, token):
+        if isinstance(token, str) == False or re.fullmatch('[0-9a-f]{32}', token) == None:
+            return None
+        with self.lock:
+            search = self.entries.get(token)
+            if search != None:
+                self.entries.move_to_end(token)
+        if search != None:
+            # Entries expire on last use in any worker, so a hit here must count on disk too; one
+            # dropped in the meantime is stored again for the other workers.
+            if self.disk.enabled() and self.disk.touch(('result', token)) == False:
+                self.store(token, search)
+            return search
+        data = self.disk.get(('result', token))
+        if data == None:
+            return None
+        search = pickle.loads(data)
+        self.remember(token, search)
+        return search
+
+    def stats(self):
+        with self.lock:
+            entries = len(self.entries)
+        return {'entries' : entries, 'max_entries' : self.maxEntries, 'disk' : self.disk.stats()}
@@ -0,0 +1,241 @@
+# Region searches: where the rows of a (reference, chromosome, start, end) query come from.
+# Rows are pos/entries frames, from the REST API or from the parquet partitions, and already
+# materialized position spans are kept so that overlapping searches only fetch the gaps.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from partitions import mergePartitions, submitPartitions
+from singleflight import FlightTimeout, SingleFlight
+
+RANGE_CACHE_ROWS = int(os.environ.get('GENIEPOOL_RANGE_CACHE_ROWS', 200000))
+# If the API has not answered after HEDGE_DELAY seconds the partition read is started alongside it;
+# a search gives up SEARCH_DEADLINE seconds after it started, whatever it was waiting on.
+HEDGE_DELAY = float(os.environ.get('GENIEPOOL_HEDGE_DELAY', 2))
+SEARCH_DEADLINE = float(os.environ.get('GENIEPOOL_SEARCH_DEADLINE', 30))
+
+
+def countVariants(df):
+    if df.empty:
+        return 0
+    return int(df['entries'].str.len().sum())
+
+def apiFrame(data, start):
+    # /rest/index answers {} when nothing matches, {'entries': [...]} for a single position
+    # and {'count': n, 'data': [{'pos': ..., 'entries': [...]}, ...]} for ranges.
+    if len(data) == 0:
+        return pd.DataFrame(columns = ['pos', 'entries']), 0
+    if 'data' not in data:
+        return pd.DataFrame({'pos' : [start], 'entries' : [data['entries']]}), len(data['entries'])
+    df = pd.json_normalize(data['data'])
+    if df.empty:
+        return pd.DataFrame(columns = ['pos', 'entries']), 0
+    return df, int(data['count'])
+
+def filtersKey(filters):
+    return tuple(sorted((k, str(v)) for k, v in filters.items()))
+
+def subtractSpans(spans, start, end):
+    # Parts of [start, end] not covered by the sorted, disjoint `spans`.
+    gaps = []
+    for spanStart, spanEnd in spans:
+        if spanEnd < start:
+            continue
+        if spanStart > end:
+            break
+        if spanStart > start:
+            gaps.append((start, spanStart - 1))
+        start = max(start, spanEnd + 1)
+        if start > end:
+            return gaps
+    gaps.append((start, end))
+    return gaps
+
+def addSpan(spans, start, end):
+    merged = []
+    for spanStart, spanEnd in sorted(spans + [(start, end)]):
+        if len(merged) > 0 and spanStart <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], spanEnd))
+        else:
+            merged.append((spanStart, spanEnd))
+    return merged
+
+
+class RangeCache:
+    # (reference, dataset version, chromosome, filters) -> covered spans and their rows sorted by pos.
+    # Whole keys are evicted least recently used first once the total row count exceeds maxRows.
+
+    def __init__(self, maxRows = RANGE_CACHE_ROWS):
+        self.maxRows = maxRows
+        self.entries = OrderedDict()
+        self.rowCount = 0
+        self.lock = threading.Lock()
+
+    def missing(self, key, start, end):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                return [(start, end)]
+            self.entries.move_to_end(key)
+            return subtractSpans(entry[0], start, end)
+
+    def add(self, key, start, end, df):
+        with self.lock:
+            spans, rows = self.entries.pop(key, ([], None))
+            if rows is not None:
+                self.rowCount -= len(rows)
+                df = pd.concat([rows[(rows['pos'] < start) | (rows['pos'] > end)], df])
+            df = df.astype({'pos' : 'int64'}).sort_values('pos', kind = 'stable').reset_index(drop = True)
+            self.entries[key] = (addSpan(spans, start, end), df)
+            self.rowCount += len(df)
+            while self.rowCount > self.maxRows and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last = False)
+                self.rowCount -= len(evicted)
+
+    def rows(self, key, start, end):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry == None:
+            return pd.DataFrame(columns = ['pos', 'entries'])
+        rows = entry[1]
+        return rows[rows['pos'].between(start, end)].reset_index(drop = True)
+
+    def stats(self):
+        with self.lock:
+            return {'keys' : len(self.entries), 'rows' : self.rowCount, 'max_rows' : self.maxRows}
+
+
+class RegionSearch:
+
+    def __init__(self, client, partitionMap, mirror = False, hedgeDelay = HEDGE_DELAY, deadline = SEARCH_DEADLINE):
+        self.client = client
+        self.partitionMap = partitionMap
+        self.mirror = mirror
+        self.hedgeDelay = hedgeDelay
+        self.deadline = deadline
+        self.rangeCache = RangeCache()
+        self.flights = SingleFlight()
+        self.executor = ThreadPoolExecutor(max_workers = 8, thread_name_prefix = 'geniepool-api')
+        self.metrics = {'api_wins' : 0, 'fallback_wins' : 0, 'hedges' : 0, 'api_failures' : 0, 'deadline_exceeded' : 0}
+        self.metricsLock = threading.Lock()
+
+    def count(self, metric):
+        with self.metricsLock:
+            self.metrics[metric] += 1
+
+    def stats(self):
+        with self.metricsLock:
+            return dict(self.metrics)
+
+    def timedOut(self, reference, chromosome, start, end):
+        self.count('deadline_exceeded')
+        return TimeoutError('No answer for ' + reference + ' ' + chromosome + ':' + str(start) + '-' + str(end) + ' within ' + str(self.deadline) + ' seconds')
+
+    def fromPartitions(self, reference, chromosome, start, end, deadline):
+        future = submitPartitions(self.partitionMap.plan(reference, chromosome, start, end), start, end)
+        done, _ = wait([future], timeout = max(0, deadline - time.monotonic()))
+        if len(done) == 0:
+            future.cancel()
+            raise self.timedOut(reference, chromosome, start, end)
+        df = mergePartitions(future.result())
+        if df.empty:
+            df = pd.DataFrame(columns = ['pos', 'entries'])
+        return df, countVariants(df)
+
+    def fromAPI(self, reference, chromosome, start, end, filters):
+        data = self.client.index(reference, chromosome + ':' + str(start) + '-' + str(end), **filters)
+        return apiFrame(data, start)
+
+    def fetch(self, reference, chromosome, start, end, filters, deadline):
+        # Identical concurrent fetches, in this worker or in others, share one upstream request.
+        key = ('region', reference, chromosome, start, end, filtersKey(filters))
+        try:
+            return self.flights.do(key, lambda : self.fetchUpstream(reference, chromosome, start, end, filters, deadline),
+                                   timeout = max(0, deadline - time.monotonic()))
+        except FlightTimeout:
+            raise self.timedOut(reference, chromosome, start, end)
+
+    def fetchUpstream(self, reference, chromosome, start, end, filters, deadline):
+        # -> (rows, variant count, whether the rows are complete and consistent with the filters)
+        serverSideFilters = any(filters.get(i) not in (0, '0', None) for i in ('gnomadNhomalt', 'gnomadAc', 'am'))
+        if self.mirror:
+            df, count = self.fromPartitions(reference, chromosome, start, end, deadline)
+            return df, count, serverSideFilters == False
+        api = self.executor.submit(self.fromAPI, reference, chromosome, start, end, filters)
+        done, _ = wait([api], timeout = max(0, min(self.hedgeDelay, deadline - time.monotonic())))
+        if len(done) > 0 and api.exception() == None:
+            self.count('api_wins')
+            df, count = api.result()
+            # The API truncates large ranges; those rows do not cover the whole span.
+            return df, count, count <= countVariants(df)
+        self.count('hedges' if len(done) == 0 else 'api_failures')
+        fallback = submitPartitions(self.partitionMap.plan(reference, chromosome, start, end), start, end)
+        pending = {fallback} if len(done) > 0 else {api, fallback}
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, timeout = max(0, deadline - time.monotonic()), return_when = FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for future in done:
+                if future.exception() != None:
+                    error = future.exception()
+                    if future is api:
+                        self.count('api_failures')
+                    continue
+                # The losing partition read is cancelled; a losing API call cannot be interrupted,
+                # but its response still lands in the client's cache.
+                for loser in pending:
+                    loser.cancel()
+                if future is api:
+                    self.count('api_wins')
+                    df, count = future.result()
+                    return df, count, count <= countVariants(df)
+                self.count('fallback_wins')
+                df = mergePartitions(future.result())
+                if df.empty:
+                    df = pd.DataFrame(columns = ['pos', 'entries'])
+                return df, countVariants(df), serverSideFilters == False
+        for future in pending:
+            future.cancel()
+        if error != None and len(pending) == 0:
+            raise error
+        raise self.timedOut(reference, chromosome, start, end)
+
+    def variantId(self, reference, rsid, filters):
+        # dbSNP searches go to the API only: the partitions are not indexed by rsid.
+        if self.mirror:
+            return pd.DataFrame(columns = ['pos', 'entries']), 0, None
+        key = ('rsid', reference, rsid, filtersKey(filters))
+        api = self.executor.submit(self.flights.do, key, lambda : self.client.index(reference, rsid, **filters), self.deadline)
+        done, _ = wait([api], timeout = self.deadline)
+        if len(done) == 0:
+            self.count('deadline_exceeded')
+        try:
+            data = api.result(timeout = 0)
+        except:
+            data = {}
+        df, count = apiFrame(data, None)
+        chromosome = str(data).split("chrom': '")[1].split("'")[0].upper() if df.empty == False else None
+        return df, count, chromosome
+
+    def region(self, reference, chromosome, start, end, filters):
+        # Rows of [start, end], fetching only the sub-ranges that are not cached yet. All of it,
+        # including waits on the same fetch by other searches, shares one deadline.
+        deadline = time.monotonic() + self.deadline
+        version = None if self.mirror else self.client.datasetVersion(reference)
+        key = (reference, version, chromosome, filtersKey(filters))
+        for gapStart, gapEnd in self.rangeCache.missing(key, start, end):
+            df, count, complete = self.fetch(reference, chromosome, gapStart, gapEnd, filters, deadline)
+            if complete == False:
+                # Rows that do not cover the gap cannot be stitched; answer with a plain search.
+                if (gapStart, gapEnd) != (start, end):
+                    df, count, _ = self.fetch(reference, chromosome, start, end, filters, deadline)
+                return df, count
+            self.rangeCache.add(key, gapStart, gapEnd, df)
+        df = self.rangeCache.rows(key, start, end)
+        return df, countVariants(df)
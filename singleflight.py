@@ -0,0 +1,161 @@
+# Coalescing of identical in-flight upstream fetches.
+# Within a worker, concurrent callers of the same key wait on the first caller's fetch. Across the
+# gunicorn workers of a host, the fetching worker holds an flock on a per-key lock file; workers
+# that find it locked leave a waiting marker, wait for the lock and read the result it left in a
+# spool file. The spool file is only written when such a marker exists. Lock files are striped over
+# a fixed number of names so that they do not accumulate.
+
+import glob
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from diskcache import privateDirectory
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FLIGHTS_DIR = os.environ.get('GENIEPOOL_SINGLEFLIGHT_DIR', os.path.join(tempfile.gettempdir(), 'geniepool-flights'))
+SPOOL_TTL = 60
+LOCK_STRIPES = 4096
+
+
+class FlightTimeout(Exception):
+    # Raised to a caller that gave up waiting for another caller's fetch
+    pass
+
+
+class Call:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self, directory = FLIGHTS_DIR):
+        self.directory = directory if fcntl != None else None
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.lastPrune = 0
+        self.leaders = 0
+        self.followers = 0
+        self.sharedFollowers = 0
+        if self.directory != None:
+            # Spool files are unpickled, so the directory must not be writable by other users.
+            privateDirectory(self.directory)
+
+    def do(self, key, function, timeout = None):
+        # -> function(), or the result of the identical call already in flight. With a `timeout`,
+        # waiting for another caller's call raises FlightTimeout after that many seconds.
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if leader == False:
+            if call.event.wait(timeout) == False:
+                raise FlightTimeout(key)
+            if call.error != None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self.acrossWorkers(key, function, timeout)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def acrossWorkers(self, key, function, timeout = None):
+        if self.directory == None:
+            return function()
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        spool = os.path.join(self.directory, digest + '.pickle')
+        waiting = os.path.join(self.directory, digest + '.waiting-')
+        stripe = int(digest[:8], 16) % LOCK_STRIPES
+        with open(os.path.join(self.directory, str(stripe) + '.lock'), 'a+') as lockFile:
+            try:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is fetching this key: wait for it and take its result if it left one.
+                waitStart = time.time()
+                marker = waiting + str(os.getpid()) + '-' + str(threading.get_ident())
+                open(marker, 'w').close()
+                try:
+                    if self.acquire(lockFile, timeout) == False:
+                        raise FlightTimeout(key)
+                finally:
+                    os.remove(marker)
+                result = self.readSpool(spool, waitStart)
+                if result != None:
+                    fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+                    with self.lock:
+                        self.sharedFollowers += 1
+                    return result[0]
+            try:
+                result = function()
+                if len(glob.glob(glob.escape(waiting) + '*')) > 0:
+                    self.writeSpool(spool, result)
+                return result
+            finally:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+    def acquire(self, lockFile, timeout):
+        # Exclusive flock of `lockFile` -> False if it could not be had within `timeout` seconds
+        if timeout == None:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+            return True
+        end = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= end:
+                    return False
+                time.sleep(0.05)
+
+    def readSpool(self, spool, notBefore):
+        try:
+            if os.path.getmtime(spool) < notBefore - 1:
+                return None
+            with open(spool, 'rb') as f:
+                return (pickle.load(f),)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def writeSpool(self, spool, result):
+        descriptor, temporary = tempfile.mkstemp(dir = self.directory, prefix = '.tmp-')
+        with os.fdopen(descriptor, 'wb') as f:
+            pickle.dump(result, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, spool)
+        if time.time() - self.lastPrune > SPOOL_TTL:
+            self.lastPrune = time.time()
+            self.prune()
+
+    def prune(self):
+        for entry in os.scandir(self.directory):
+            try:
+                if (entry.name.endswith('.pickle') or '.waiting-' in entry.name) and time.time() - entry.stat().st_mtime > SPOOL_TTL:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {'leaders' : self.leaders, 'followers' : self.followers, 'cross_worker_followers' : self.sharedFollowers, 'in_flight' : len(self.calls)}
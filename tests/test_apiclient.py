@@ -0,0 +1,55 @@
+# The circuit breaker guarding GeniePool API calls.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apiclient import CircuitBreaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failureThreshold = 3, resetTimeout = 60)
+    breaker.recordFailure()
+    breaker.recordFailure()
+    breaker.recordSuccess()
+    breaker.recordFailure()
+    breaker.recordFailure()
+    assert breaker.state() == 'closed' and breaker.allow() == True
+    breaker.recordFailure()
+    assert breaker.state() == 'open'
+    assert breaker.allow() == False
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = CircuitBreaker(failureThreshold = 1, resetTimeout = 0.1)
+    breaker.recordFailure()
+    assert breaker.allow() == False
+    time.sleep(0.15)
+    assert breaker.state() == 'half-open'
+    assert breaker.allow() == True
+    assert breaker.allow() == False
+
+def test_a_successful_trial_closes_the_circuit():
+    breaker = CircuitBreaker(failureThreshold = 2, resetTimeout = 0.1)
+    breaker.recordFailure()
+    breaker.recordFailure()
+    time.sleep(0.15)
+    assert breaker.allow() == True
+    breaker.recordSuccess()
+    assert breaker.state() == 'closed'
+    assert breaker.allow() == True and breaker.allow() == True
+    # failures are counted again from zero
+    breaker.recordFailure()
+    assert breaker.state() == 'closed'
+
+def test_a_failed_trial_reopens_the_circuit():
+    breaker = CircuitBreaker(failureThreshold = 2, resetTimeout = 0.1)
+    breaker.recordFailure()
+    breaker.recordFailure()
+    time.sleep(0.15)
+    assert breaker.allow() == True
+    breaker.recordFailure()
+    assert breaker.state() == 'open' and breaker.allow() == False
+    time.sleep(0.15)
+    assert breaker.allow() == True
@@ -0,0 +1,92 @@
+# DiskCache byte budget, eviction and expiry, with several workers on one directory.
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diskcache import DiskCache, privateDirectory
+
+
+def counted(cache):
+    with cache.sharedUsage() as usage:
+        return usage[0]
+
+
+def test_get_returns_what_was_put(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000)
+    cache.put(('a', 1), b'x' * 10)
+    assert cache.get(('a', 1)) == b'x' * 10
+    assert cache.get(('a', 2)) == None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+def test_entries_larger_than_the_budget_are_not_kept(tmp_path):
+    cache = DiskCache(str(tmp_path), 100)
+    cache.put(('big',), b'x' * 101)
+    assert cache.get(('big',)) == None
+    assert counted(cache) == 0
+
+def test_budget_holds_across_workers(tmp_path):
+    workers = [DiskCache(str(tmp_path), 1000), DiskCache(str(tmp_path), 1000)]
+    for n in range(40):
+        workers[n % 2].put(('key', n), b'x' * 100)
+        assert workers[0].usage() <= 1000
+    assert counted(workers[0]) == workers[0].usage()
+    # the least recently written go first
+    assert workers[0].get(('key', 39)) != None and workers[0].get(('key', 0)) == None
+
+def test_eviction_spares_recently_read_entries(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000, lowWatermark = 0.5)
+    for n in range(9):
+        cache.put(('key', n), b'x' * 100)
+        os.utime(cache.path(('key', n)), (time.time() - 100 + n, time.time() - 100 + n))
+    cache.get(('key', 0))
+    cache.put(('key', 9), b'x' * 200)
+    assert cache.get(('key', 0)) != None
+    assert cache.get(('key', 1)) == None
+    assert counted(cache) == cache.usage() <= 500
+
+def test_concurrent_writers_of_one_key_count_it_once(tmp_path):
+    workers = [DiskCache(str(tmp_path), 10 ** 6) for _ in range(4)]
+    def write(cache, size):
+        for n in range(50):
+            cache.put(('same',), b'x' * (size + n))
+    threads = [threading.Thread(target = write, args = (cache, 100 * (i + 1))) for i, cache in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counted(workers[0]) == workers[0].usage() == os.path.getsize(workers[0].path(('same',)))
+
+def test_expired_entries_are_dropped_and_uncounted(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000, maxAge = 60)
+    cache.put(('old',), b'x' * 100)
+    cache.put(('new',), b'x' * 100)
+    os.utime(cache.path(('old',)), (time.time() - 61, time.time() - 61))
+    assert cache.get(('old',)) == None
+    assert cache.get(('new',)) != None
+    assert counted(cache) == 100
+
+def test_touch_keeps_an_entry_alive(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000, maxAge = 60)
+    cache.put(('key',), b'x')
+    os.utime(cache.path(('key',)), (time.time() - 59, time.time() - 59))
+    assert cache.touch(('key',)) == True
+    cache.expire()
+    assert cache.get(('key',)) == b'x'
+    assert cache.touch(('missing',)) == False
+
+def test_private_directory(tmp_path):
+    path = str(tmp_path / 'private')
+    os.makedirs(path, mode = 0o777)
+    os.chmod(path, 0o777)
+    assert privateDirectory(path) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.symlink(path, str(tmp_path / 'link'))
+    try:
+        privateDirectory(str(tmp_path / 'link'))
+        assert False, 'a symlink was accepted'
+    except PermissionError:
+        pass
@@ -0,0 +1,60 @@
+# Streaming exports of a stored search.
+
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import export
+from results import VariantResult
+
+
+def variantCalls():
+    mutations = [
+        {'ref' : 'A', 'alt' : 'G', 'impact' : 'missense', 'dbSNP' : 'rs1', 'alphamissense' : '0.7',
+         'hom' : [{'id' : 'SRR1', 'qual' : 60, 'ad' : '0,30'}], 'het' : [{'id' : 'SRR2', 'qual' : 20, 'ad' : '10,5'}]},
+        {'ref' : 'C', 'alt' : 'T', 'impact' : 'a;b=c', 'hom' : [], 'het' : [{'id' : 'SRR3', 'qual' : 40, 'ad' : '12,8'}]},
+        {'ref' : 'G', 'alt' : 'A', 'hom' : [{'id' : 'SRR4', 'qual' : 10, 'ad' : '0,2'}], 'het' : []},
+    ]
+    return VariantResult.fromMutations(['7', '7', '7'], [100, 200, 300], mutations)
+
+def collect(chunks):
+    return b''.join(chunk.encode() if isinstance(chunk, str) else chunk for chunk in chunks)
+
+GENES = ['CFTR', 'CFTR', '']
+
+
+def test_csv_has_one_row_per_passing_call_with_integer_quality():
+    data = collect(export.stream('csv', variantCalls(), GENES, 'hg38', minQual = 20))
+    df = pd.read_csv(io.BytesIO(data), dtype = {'Qual' : str})
+    assert df.columns.tolist() == export.CALL_COLUMNS
+    assert df['Run'].tolist() == ['SRR1', 'SRR2', 'SRR3']
+    assert df['Qual'].tolist() == ['60', '20', '40']
+    assert df['Coverage'].tolist() == [30, 15, 20]
+    assert df['Zygosity'].tolist() == ['hom', 'het', 'het']
+
+def test_variants_are_exported_in_the_given_order():
+    data = collect(export.stream('tsv', variantCalls(), GENES, 'hg38', variants = np.array([1, 0])))
+    df = pd.read_csv(io.BytesIO(data), sep = '\t')
+    assert df['Position'].tolist() == [200, 100, 100]
+    assert df['Run'].tolist() == ['SRR3', 'SRR1', 'SRR2']
+    assert collect(export.stream('csv', variantCalls(), GENES, 'hg38', variants = np.array([], dtype = np.int64))).decode().strip() == ','.join(export.CALL_COLUMNS)
+
+def test_parquet_chunks_share_one_schema():
+    frames = export.callFrames(variantCalls(), GENES, chunkRows = 1)
+    table = pq.read_table(io.BytesIO(collect(export.parquet(frames))))
+    assert table.num_rows == 4
+    assert table.column('Qual').to_pylist() == [60, 20, 40, 10]
+
+def test_vcf_records_escape_info_and_skip_variants_without_calls():
+    lines = collect(export.stream('vcf', variantCalls(), GENES, 'hg38', minQual = 20, variants = np.array([2, 1, 0]))).decode().splitlines()
+    records = [line.split('\t') for line in lines if line.startswith('#') == False]
+    assert [record[1] for record in records] == ['200', '100']
+    assert records[0][7] == 'GENE=CFTR;IMPACT=a%3Bb%3Dc;NHOM=0;NHET=1;HET=SRR3'
+    assert records[1][2] == 'rs1'
+    assert 'AM=0.7' in records[1][7] and 'HOM=SRR1' in records[1][7]
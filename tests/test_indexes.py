@@ -0,0 +1,109 @@
+# Indexes over the tables referencedata builds.
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import referencedata
+from indexes import AttributeIndex, GeneIndex, GeneIntervalIndex, SampleDictionary, StudyIndex, fixedWidth, column, symbolSlots
+
+GENES = pd.DataFrame({
+    'Gene' : ['BRCA2', 'BRCA1', 'brca1', 'TP53', 'BRCA1P1', 'CFTR', 'NOCOORD'],
+    'hg38' : ['13:100-200', '17:300-900', '17:1-2', '17:500-600', '17:850-1000', '7:10-50', None],
+    'hg19' : ['13:1-2', 'chr17:3-9', '17:1-2', '17:5-6', '17:8-10', '7:1-5', None],
+    'chm13v2' : ['13:1-2', '17:3-9', '17:1-2', '17:5-6', '17:8-10', 'chrMT:1-5', None],
+})
+
+
+@pytest.fixture
+def samples(tmp_path):
+    pd.DataFrame({
+        'Run' : ['SRR3', 'SRR1', 'SRR2', 'SRR1'],
+        'BioSample' : ['SAMN3', 'SAMN1', 'SAMN2', 'SAMN1'],
+        'Study Title' : ['Study B', 'Study A', 'Study A', 'Study B'],
+    }).to_csv(tmp_path / 'SRA_studies_and_samples.tsv', sep = '\t', index = False)
+    pq.write_table(pa.table({'Run' : ['SRR2', 'SRR4'], 'Attributes' : [['sex: male', 'tissue: blood'], ['sex: female']]}), str(tmp_path / 'attributes.parquet'))
+    return referencedata.buildSamples(str(tmp_path / 'SRA_studies_and_samples.tsv'), str(tmp_path / 'attributes.parquet'))
+
+@pytest.fixture
+def tables(tmp_path):
+    path = tmp_path / 'genes_to_coordinates.parquet'
+    GENES.to_parquet(path)
+    return referencedata.buildGenes(str(path))
+
+
+def test_lookup_is_case_insensitive_and_keeps_the_first_symbol(tables):
+    genes = GeneIndex.fromTables(tables)
+    assert genes.lookup(' brca1 ', 'hg38') == '17:300-900'
+    assert genes.lookup('TP53', 'hg19') == '17:5-6'
+    assert genes.lookup('BRCA', 'hg38') == None
+    assert genes.lookup('A' * 50, 'hg38') == None
+    assert genes.lookup('NOCOORD', 'hg38') == None
+
+def test_every_key_hashes_to_its_row():
+    keys = [('GENE' + str(n)).encode() for n in range(1000)]
+    slots = symbolSlots(keys)
+    assert len(slots) >= 2 * len(keys)
+    assert sorted(slots[slots > 0] - 1) == list(range(1000))
+
+def test_complete_returns_prefix_matches_in_key_order(tables):
+    genes = GeneIndex.fromTables(tables)
+    assert [entry['gene'] for entry in genes.complete('brca')] == ['BRCA1', 'brca1', 'BRCA1P1', 'BRCA2']
+    assert [entry['gene'] for entry in genes.complete('BRCA', limit = 2)] == ['BRCA1', 'brca1']
+    assert genes.complete('  ') == []
+    assert genes.complete('Z' * 50) == []
+    assert genes.complete('CFTR')[0] == {'gene' : 'CFTR', 'hg38' : '7:10-50', 'hg19' : '7:1-5', 'chm13v2' : 'chrMT:1-5'}
+
+
+def test_overlapping_genes_of_a_position_or_range(tables):
+    intervals = GeneIntervalIndex.fromTables(tables)
+    assert intervals.overlapping('hg38', '17', 550) == ['BRCA1', 'TP53']
+    assert intervals.overlapping('hg38', 'chr17', 880, 890) == ['BRCA1', 'BRCA1P1']
+    assert intervals.overlapping('hg38', '17', 901, 2000) == ['BRCA1P1']
+    assert intervals.overlapping('hg38', '17', 3, 299) == []
+    assert intervals.overlapping('hg38', 'X', 1) == []
+    assert intervals.overlapping('chm13v2', 'chrM', 3) == ['CFTR']
+
+def test_annotate_labels_each_coordinate(tables):
+    intervals = GeneIntervalIndex.fromTables(tables)
+    labels = intervals.annotate('hg38', ['17:550', 'chr7:20', '13:150-160', 'X:5', '17:bad', '17:250', '7:50'])
+    assert labels.tolist() == ['BRCA1, TP53', 'CFTR', 'BRCA2', '', '', '', 'CFTR']
+    assert intervals.annotate('chm13v2', ['MT:2', 'chrM:6']).tolist() == ['CFTR', '']
+    assert len(intervals.annotate('hg38', [])) == 0
+
+def test_reference_runs_are_sorted_codes_and_new_runs_follow(samples):
+    dictionary = SampleDictionary()
+    dictionary.load(fixedWidth(column(samples['samples'], 'Run')))
+    assert dictionary.encode(['SRR4', 'SRR1', 'SRR9', 'SRR10000']).tolist() == [3, 0, -1, -1]
+    assert dictionary.intern(['SRR9', 'SRR2', 'SRR9']).tolist() == [4, 1, 4]
+    assert dictionary.decode([4, 0, 3]).tolist() == ['SRR9', 'SRR1', 'SRR4']
+    assert len(dictionary) == 5
+    with pytest.raises(RuntimeError):
+        dictionary.load(fixedWidth(column(samples['samples'], 'Run')))
+
+def test_a_run_of_several_studies_has_a_row_in_each(samples):
+    studies = StudyIndex.fromTables(samples)
+    positions, rows = studies.rowsOf(np.array([0, 3, -1, 2, 7]))
+    assert positions.tolist() == [0, 0, 3]
+    assert rows.tolist() == [1, 3, 0]
+    assert studies.titles(studies.studyCodes[rows]) == ['Study A', 'Study B', 'Study B']
+    assert studies.bioSamplesOf(rows).tolist() == ['SAMN1', 'SAMN1', 'SAMN3']
+    ranked, rank = studies.rank(rows)
+    assert studies.titles(ranked) == ['Study B', 'Study A']
+    assert rank.tolist() == [1, 0, 0]
+
+def test_attribute_postings_and_facets(samples):
+    attributes = AttributeIndex.fromTables(samples)
+    codes = np.array([1, 3, 1, 0])
+    assert attributes.rowsWithAny(np.array([0, 1, 2, 2]), codes, 3, ['sex: male']).tolist() == [True, False, True]
+    assert attributes.rowsWithAny(np.array([0, 1, 2, 2]), codes, 3, ['unknown']).tolist() == [False, False, False]
+    facets = attributes.facetCounts(np.array([0, 1, 2, 2]), codes, 3).set_index('Attribute')
+    assert facets.loc['sex: male'].tolist() == [1, 2]
+    assert facets.loc['sex: female'].tolist() == [1, 1]
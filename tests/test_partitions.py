@@ -0,0 +1,79 @@
+# Row-group pruning, ranged reads and footers of the parquet partitions.
+
+import io
+import os
+import sys
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import partitions
+from partitions import SparseFile, columnRanges, mergePartitions, selectRowGroups, submitPartitions
+
+
+def writePartition(path, positions, label, rowGroupSize = 10):
+    table = pa.table({'pos' : positions, 'entries' : [[label + str(p)] for p in positions], 'padding' : ['x' * 50] * len(positions)})
+    pq.write_table(table, path, row_group_size = rowGroupSize)
+
+def read(uri, start, end):
+    return mergePartitions(submitPartitions([uri], start, end).result(timeout = 10))
+
+
+def test_row_groups_are_selected_by_pos_statistics(tmp_path):
+    path = str(tmp_path / 'part.parquet')
+    writePartition(path, list(range(0, 100)), 'a')
+    metadata = pq.read_metadata(path)
+    assert metadata.num_row_groups == 10
+    assert selectRowGroups(metadata, 25, 34) == [2, 3]
+    assert selectRowGroups(metadata, 95, 500) == [9]
+    assert selectRowGroups(metadata, 100, 500) == []
+
+def test_column_ranges_cover_only_the_requested_columns(tmp_path):
+    path = str(tmp_path / 'part.parquet')
+    writePartition(path, list(range(0, 100)), 'a')
+    metadata = pq.read_metadata(path)
+    ranges = columnRanges(metadata, [2, 3], ('pos', 'entries'))
+    assert len(ranges) == 2
+    with open(path, 'rb') as f:
+        data = f.read()
+    source = SparseFile(len(data), ranges, [data[start:end] for start, end in ranges])
+    table = pq.ParquetFile(source, metadata = metadata, pre_buffer = False).read_row_groups([2, 3], columns = ['pos', 'entries'])
+    assert table.column('pos').to_pylist() == list(range(20, 40))
+    with pytest.raises(IOError):
+        pq.ParquetFile(source, metadata = metadata, pre_buffer = False).read_row_groups([4], columns = ['pos'])
+
+def test_sparse_file_reads_within_fetched_ranges():
+    source = SparseFile(100, [(10, 20), (50, 60)], [bytes(range(10, 20)), bytes(range(50, 60))])
+    source.seek(15)
+    assert source.read(3) == bytes([15, 16, 17])
+    assert source.read(10) == bytes([18, 19])
+    source.seek(-45, io.SEEK_END)
+    buffer = bytearray(4)
+    assert source.readinto(buffer) == 4 and bytes(buffer) == bytes([55, 56, 57, 58])
+    source.seek(30)
+    with pytest.raises(IOError):
+        source.read(1)
+
+def test_region_reads_return_only_the_region(tmp_path):
+    path = str(tmp_path / 'part.parquet')
+    writePartition(path, list(range(0, 100)), 'a')
+    df = read(path, 25, 34)
+    assert df['pos'].tolist() == list(range(25, 35))
+    assert df['entries'].iloc[0].tolist() == ['a25']
+    assert read(path, 200, 300).empty
+
+def test_a_rewritten_partition_is_read_with_its_own_footer(tmp_path, monkeypatch):
+    monkeypatch.setattr(partitions, 'footerCache', partitions.FooterCache())
+    path = str(tmp_path / 'part.parquet')
+    writePartition(path, list(range(0, 100)), 'old')
+    assert read(path, 50, 52)['entries'].str[0].tolist() == ['old50', 'old51', 'old52']
+    writePartition(path, list(range(0, 100, 2)), 'new', rowGroupSize = 7)
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    df = read(path, 50, 52)
+    assert df['pos'].tolist() == [50, 52]
+    assert df['entries'].str[0].tolist() == ['new50', 'new52']
@@ -0,0 +1,147 @@
+# VariantResult filtering, the table's filter/sort/paging and the ResultStore.
+
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indexes import sampleDictionary
+from results import ResultStore, VariantResult, filterFrame, page, parseDepths, sortFrame
+
+
+def mutation(ref, alt, homs, hets):
+    return {'ref' : ref, 'alt' : alt, 'hom' : homs, 'het' : hets}
+
+def call(run, qual, ad):
+    return {'id' : run, 'qual' : qual, 'ad' : ad}
+
+def randomResult(seed, nVariants = 40):
+    random = np.random.default_rng(seed)
+    mutations = []
+    for n in range(nVariants):
+        calls = [call('SRR' + str(random.integers(1000)), int(random.choice([5, 10, 30, 30, 60, 99])), str(random.integers(20)) + ',' + str(random.integers(20)))
+                 for _ in range(random.integers(0, 12))]
+        split = random.integers(0, len(calls) + 1)
+        mutations.append(mutation('A', 'G', calls[:split], calls[split:]))
+    return VariantResult.fromMutations(['7'] * nVariants, list(range(100, 100 + nVariants)), mutations)
+
+
+def test_mask_matches_the_thresholds():
+    for seed in range(20):
+        result = randomResult(seed)
+        for minQual in (None, 0, 5, 6, 30, 31, 99, 100):
+            for minCoverage in (None, 0, 10, 25):
+                expected = (result.qual >= (minQual or 0)) & (result.coverage >= (minCoverage or 0))
+                assert np.array_equal(result.mask(minQual, minCoverage), expected)
+
+def test_calls_of_a_group_are_in_decreasing_quality():
+    result = VariantResult.fromMutations(['1'], [10], [mutation('A', 'T', [call('SRR1', 10, '0,5'), call('SRR2', 50, '0,5')], [call('SRR3', 20, '1,5'), call('SRR4', 40, '1,5')])])
+    assert [c['id'] for c in result.records] == ['SRR2', 'SRR1', 'SRR4', 'SRR3']
+    assert result.mask(30).tolist() == [True, False, True, False]
+
+def test_table_drops_variants_without_passing_calls():
+    result = VariantResult.fromMutations(['1', '1'], [10, 20], [mutation('A', 'T', [call('SRR1', 10, '0,5')], []),
+                                                                 mutation('C', 'G', [], [call('SRR2', 50, '3,30')])])
+    table = result.table(minQual = 20)
+    assert table['Coordinate'].tolist() == ['1:20']
+    assert table['Heterozygotes'].tolist() == [1]
+    assert result.coverage.tolist() == [5, 33]
+
+def test_empty_result():
+    result = VariantResult.fromMutations([], [], [])
+    assert len(result.mask(30, 10)) == 0
+    assert result.table(30, 10).empty
+
+def test_depths_of_multi_allelic_calls():
+    alt, total = parseDepths(['3,7', '0,4,9', '12', '1,2,3,4'])
+    assert alt.tolist() == [7, 4, 0, 2]
+    assert total.tolist() == [10, 13, 12, 10]
+
+def threeVariants():
+    return VariantResult.fromMutations(['2', '2', '2'], [10, 20, 30], [
+        mutation('A', 'T', [call('SRR1', 40, '0,20')], [call('SRR2', 10, '5,5'), call('SRR3', 50, '9,1')]),
+        mutation('C', 'G', [], [call('SRR4', 5, '1,1')]),
+        mutation('G', 'C', [call('SRR5', 30, '0,40'), call('SRR1', 35, '0,2')], [])])
+
+def test_counts_samples_and_calls_follow_the_table_rows():
+    result = threeVariants()
+    mask = result.mask(20, 10)
+    homs, hets = result.counts(mask)
+    assert homs.tolist() == [1, 0, 1] and hets.tolist() == [1, 0, 0]
+    assert [[c['id'] for c in calls] for calls in result.samples(mask & ~result.hom, hets)] == [['SRR3'], [], []]
+    rows, codes = result.calls(20, 10)
+    # the second variant has no passing call, so the third one is row 1 of the table
+    assert rows.tolist() == [0, 0, 1]
+    assert sampleDictionary.decode(codes).tolist() == ['SRR1', 'SRR3', 'SRR5']
+    assert result.table(20, 10)['Coordinate'].tolist() == ['2:10', '2:30']
+    assert result.variantsOf([1, 0], 20, 10).tolist() == [2, 0]
+
+def test_results_survive_pickling():
+    result = threeVariants()
+    copy = pickle.loads(pickle.dumps(result))
+    assert np.array_equal(copy.mask(30), result.mask(30))
+    assert np.array_equal(sampleDictionary.decode(copy.codes), sampleDictionary.decode(result.codes))
+
+def storedSearch():
+    return {'reference' : 'hg38', 'calls' : randomResult(0), 'view' : ((0, 0), 'formatted')}
+
+def test_store_resolves_tokens_in_other_workers_without_the_view(tmp_path):
+    token = ResultStore(directory = str(tmp_path)).put(storedSearch())
+    search = ResultStore(directory = str(tmp_path)).get(token)
+    assert search['reference'] == 'hg38' and 'view' not in search
+    assert len(search['calls']) == 40
+    assert ResultStore(directory = str(tmp_path)).get('0' * 32) == None
+    assert ResultStore(directory = str(tmp_path)).get('../' + token) == None
+
+def test_hits_in_memory_keep_the_stored_search_alive(tmp_path):
+    worker, other = ResultStore(directory = str(tmp_path), ttl = 60), ResultStore(directory = str(tmp_path), ttl = 60)
+    token = worker.put(storedSearch())
+    path = worker.disk.path(('result', token))
+    os.utime(path, (time.time() - 50, time.time() - 50))
+    assert worker.get(token) != None
+    assert time.time() - os.path.getmtime(path) < 5
+    os.remove(path)
+    assert worker.get(token) != None
+    assert other.get(token)['reference'] == 'hg38'
+
+
+TABLE = pd.DataFrame({
+    'Coordinate' : ['7:100', '7:200', '7:300', '7:400'],
+    'Variant' : ['A>G', 'C>T', 'a>T', 'G>A'],
+    'Homozygotes' : [3, 0, 12, 1],
+    'gnomAD frequency' : [0.5, 0.0, 0.001, 2.5],
+})
+
+def test_filter_terms_are_combined():
+    assert filterFrame(TABLE, '{Homozygotes} > 0 && {Variant} contains A>')['Coordinate'].tolist() == ['7:100', '7:300']
+    assert filterFrame(TABLE, '{Variant} scontains A>')['Coordinate'].tolist() == ['7:100']
+    assert filterFrame(TABLE, '{Homozygotes} ge 3')['Coordinate'].tolist() == ['7:100', '7:300']
+    assert filterFrame(TABLE, '{gnomAD frequency} <= 0.001')['Coordinate'].tolist() == ['7:200', '7:300']
+    assert filterFrame(TABLE, '{Variant} = "c>t"')['Coordinate'].tolist() == ['7:200']
+    assert filterFrame(TABLE, '{Coordinate} datestartswith 7:1')['Coordinate'].tolist() == ['7:100']
+
+def test_bad_filter_terms():
+    assert filterFrame(TABLE, None) is TABLE and filterFrame(TABLE, '') is TABLE
+    assert len(filterFrame(TABLE, '{Nope} > 1')) == 4
+    assert len(filterFrame(TABLE, 'garbage')) == 4
+    assert filterFrame(TABLE, '{Homozygotes} > many').empty
+
+def test_sort_is_stable_over_several_columns():
+    table = TABLE.assign(Group = [1, 0, 1, 0])
+    sortBy = [{'column_id' : 'Group', 'direction' : 'asc'}, {'column_id' : 'Homozygotes', 'direction' : 'desc'}]
+    assert sortFrame(table, sortBy)['Coordinate'].tolist() == ['7:400', '7:200', '7:300', '7:100']
+    assert sortFrame(table, [{'column_id' : 'Group', 'direction' : 'desc'}])['Coordinate'].tolist() == ['7:100', '7:300', '7:200', '7:400']
+    assert sortFrame(table, []) is table
+
+def test_pages():
+    table = pd.DataFrame({'n' : range(51)})
+    rows, count = page(table, 2)
+    assert count == 3 and rows['n'].tolist() == [50]
+    assert page(table, None)[0]['n'].tolist() == list(range(25))
+    assert page(table.iloc[:0], 0)[1] == 1
+    assert page(table, 5, size = 10)[0]['n'].tolist() == [50]
@@ -0,0 +1,89 @@
+# RegionSearch deadlines with an upstream that never answers.
+
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import search
+from apiclient import GeniePoolClient
+from singleflight import SingleFlight
+
+DEADLINE = 1
+HEDGE_DELAY = 0.2
+
+
+class StubPartitionMap:
+
+    def plan(self, reference, chromosome, start, end):
+        return ['memory://partition']
+
+
+def stall(*args, **kwargs):
+    time.sleep(5)
+    return {}, b'{}'
+
+
+@pytest.fixture
+def stalledPartitions(monkeypatch):
+    # Partition reads that never complete
+    futures = []
+    def submit(uris, start, end):
+        futures.append(Future())
+        return futures[-1]
+    monkeypatch.setattr(search, 'submitPartitions', submit)
+    return futures
+
+def regionSearch(tmp_path, client, mirror = False):
+    regionSearch = search.RegionSearch(client, StubPartitionMap(), mirror = mirror, hedgeDelay = HEDGE_DELAY, deadline = DEADLINE)
+    regionSearch.flights = SingleFlight(str(tmp_path / 'flights'))
+    return regionSearch
+
+def stalledClient():
+    client = GeniePoolClient()
+    client.status = lambda reference : stall()[0]
+    client.request = stall
+    return client
+
+def timed(function, *args):
+    start = time.monotonic()
+    try:
+        return function(*args), time.monotonic() - start
+    except TimeoutError as error:
+        return error, time.monotonic() - start
+
+
+def test_stalled_api_and_partitions_hit_the_deadline(tmp_path, stalledPartitions):
+    result, elapsed = timed(regionSearch(tmp_path, stalledClient()).region, 'hg38', '7', 1, 100, {})
+    assert isinstance(result, TimeoutError)
+    assert elapsed < DEADLINE + 0.5
+    assert all(future.cancelled() for future in stalledPartitions)
+
+def test_stalled_status_does_not_delay_the_search(tmp_path):
+    client = stalledClient()
+    data = {'count' : 1, 'data' : [{'pos' : 5, 'entries' : [{'ref' : 'A', 'alt' : 'G'}]}]}
+    client.request = lambda query : (data, json.dumps(data).encode())
+    (df, count), elapsed = timed(regionSearch(tmp_path, client).region, 'hg38', '7', 1, 100, {})
+    assert count == 1
+    assert elapsed < HEDGE_DELAY
+
+def test_stalled_mirror_hits_the_deadline(tmp_path, stalledPartitions):
+    result, elapsed = timed(regionSearch(tmp_path, stalledClient(), mirror = True).region, 'hg38', '7', 1, 100, {})
+    assert isinstance(result, TimeoutError)
+    assert elapsed < DEADLINE + 0.5
+
+def test_waiting_on_a_stalled_search_hits_the_deadline(tmp_path, stalledPartitions):
+    searches = regionSearch(tmp_path, stalledClient())
+    leader = threading.Thread(target = timed, args = (searches.region, 'hg38', '7', 1, 100, {}))
+    leader.start()
+    time.sleep(0.5)
+    result, elapsed = timed(searches.region, 'hg38', '7', 1, 100, {})
+    leader.join()
+    assert isinstance(result, TimeoutError)
+    assert elapsed < DEADLINE + 0.5
@@ -0,0 +1,121 @@
+# SingleFlight coalescing within a worker and across workers sharing a directory.
+
+import glob
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from singleflight import FlightTimeout, SingleFlight
+
+
+class Upstream:
+    # Counts calls and blocks each of them until released
+
+    def __init__(self, result = 'rows'):
+        self.result = result
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def inThreads(function, n):
+    results = [None] * n
+    def run(i):
+        try:
+            results[i] = function()
+        except Exception as error:
+            results[i] = error
+    threads = [threading.Thread(target = run, args = (i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def join(threads):
+    for thread in threads:
+        thread.join(5)
+
+
+def test_concurrent_callers_in_a_worker_share_one_call(tmp_path):
+    flights = SingleFlight(str(tmp_path))
+    upstream = Upstream()
+    threads, results = inThreads(lambda : flights.do(('region', 1), upstream), 5)
+    assert upstream.started.wait(5)
+    time.sleep(0.1)
+    upstream.release.set()
+    join(threads)
+    assert results == ['rows'] * 5
+    assert upstream.calls == 1
+    assert flights.stats()['in_flight'] == 0
+
+def test_followers_get_the_leaders_error(tmp_path):
+    flights = SingleFlight(str(tmp_path))
+    upstream = Upstream(ValueError('upstream failed'))
+    threads, results = inThreads(lambda : flights.do(('region', 1), upstream), 3)
+    assert upstream.started.wait(5)
+    time.sleep(0.1)
+    upstream.release.set()
+    join(threads)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert upstream.calls == 1
+
+def test_a_follower_gives_up_at_its_timeout(tmp_path):
+    flights = SingleFlight(str(tmp_path))
+    upstream = Upstream()
+    threads, results = inThreads(lambda : flights.do(('region', 1), upstream), 1)
+    assert upstream.started.wait(5)
+    start = time.monotonic()
+    with pytest.raises(FlightTimeout):
+        flights.do(('region', 1), lambda : 'other', timeout = 0.2)
+    assert time.monotonic() - start < 1
+    upstream.release.set()
+    join(threads)
+    assert results == ['rows']
+
+def test_a_worker_waiting_on_another_gets_its_result(tmp_path):
+    leader, follower = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    upstream = Upstream()
+    threads, results = inThreads(lambda : leader.do(('region', 1), upstream), 1)
+    assert upstream.started.wait(5)
+    followerUpstream = Upstream('not shared')
+    followerUpstream.release.set()
+    waiting, followed = inThreads(lambda : follower.do(('region', 1), followerUpstream), 1)
+    time.sleep(0.2)
+    assert len(glob.glob(str(tmp_path / '*.waiting-*'))) == 1
+    upstream.release.set()
+    join(threads + waiting)
+    assert results == ['rows'] and followed == ['rows']
+    assert followerUpstream.calls == 0
+    assert follower.stats()['cross_worker_followers'] == 1
+    assert glob.glob(str(tmp_path / '*.waiting-*')) == []
+
+def test_results_are_only_spooled_for_waiting_workers(tmp_path):
+    flights = SingleFlight(str(tmp_path))
+    assert flights.do(('region', 1), lambda : 'rows') == 'rows'
+    assert glob.glob(str(tmp_path / '*.pickle')) == []
+
+def test_a_worker_waiting_on_another_gives_up_at_its_timeout(tmp_path):
+    leader, follower = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    upstream = Upstream()
+    threads, _ = inThreads(lambda : leader.do(('region', 1), upstream), 1)
+    assert upstream.started.wait(5)
+    start = time.monotonic()
+    with pytest.raises(FlightTimeout):
+        follower.do(('region', 1), lambda : 'other', timeout = 0.3)
+    assert 0.3 <= time.monotonic() - start < 1.5
+    assert glob.glob(str(tmp_path / '*.waiting-*')) == []
+    upstream.release.set()
+    join(threads)
+    assert glob.glob(str(tmp_path / '*.pickle')) == []